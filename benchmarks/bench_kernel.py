@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# O3METER
+# Copyright (C) 2018 Orlando Garcia-Feal - Universidade de Vigo - orlando@uvigo.es
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+################################################################################
+#
+# Compares the whole-image kernel (darkPixelsMean) with the original
+# implementation of CalculationThread.computeAll: results must be identical,
+# and the wall time and peak memory of both are reported.
+#
+#   benchmarks/bench_kernel.py [--megapixels 1 12 24] [--repeat 3]
+#
+import sys, os, time, argparse, tracemalloc
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import O3METER
+
+## Original computeAll math, kept as the reference.
+def legacyDarkPixelsMean(arr):
+    redPixels = arr[:, :, 2].reshape(-1)
+    greenPixels = arr[:, :, 1].reshape(-1)
+    bluePixels = arr[:, :, 0].reshape(-1)
+
+    nps = redPixels.size
+
+    values_t = numpy.fmax(redPixels, greenPixels)
+    values = numpy.fmax(values_t, bluePixels)
+
+    rvals = numpy.where(values < 150, redPixels, numpy.zeros(nps))
+    gvals = numpy.where(values < 150, greenPixels, numpy.zeros(nps))
+    bvals = numpy.where(values < 150, bluePixels, numpy.zeros(nps))
+
+    nvals = numpy.count_nonzero(rvals)
+
+    if nvals < 100 :
+        rvals = numpy.where(values < 250, redPixels, numpy.zeros(nps))
+        gvals = numpy.where(values < 250, greenPixels, numpy.zeros(nps))
+        bvals = numpy.where(values < 250, bluePixels, numpy.zeros(nps))
+        nvals = numpy.count_nonzero(rvals)
+
+    rMean = int(numpy.sum(rvals) / nvals)
+    gMean = int(numpy.sum(gvals) / nvals)
+    bMean = int(numpy.sum(bvals) / nvals)
+
+    return rMean, gMean, bMean, nvals
+
+## Synthetic photograph: bright noisy background with three dark stripes.
+# @param megapixels size of the image
+# @param bright if True the stripes are too bright for the 150 cutoff
+# @returns BGRA numpy array
+def stripeImage(megapixels, bright=False, seed=0):
+    rng = numpy.random.default_rng(seed)
+    height = int((megapixels * 1e6 * 2 / 3) ** 0.5)
+    width = int(megapixels * 1e6 / height)
+    arr = rng.integers(200, 256, size=(height, width, 4), dtype=numpy.uint8)
+    base = 160 if bright else 40
+    for k in range(3):
+        x0 = width // 8 + k * width // 4
+        stripe = arr[height // 6:5 * height // 6, x0:x0 + width // 8, :3]
+        stripe[...] = rng.integers(base, base + 80, size=stripe.shape, dtype=numpy.uint8)
+    return arr
+
+## Runs a kernel and returns its result, best wall time and peak memory.
+def measure(kernel, arr, repeat):
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = kernel(arr)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    kernel(arr)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--megapixels", type=float, nargs='+', default=[1, 12, 24])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    status = 0
+    print("%8s %7s %12s %12s %12s %12s  %s" % ("MP", "bright", "legacy s", "kernel s",
+                                               "legacy MiB", "kernel MiB", "result"))
+    for mp in args.megapixels:
+        for bright in (False, True):
+            arr = stripeImage(mp, bright)
+            old, oldTime, oldPeak = measure(legacyDarkPixelsMean, arr, args.repeat)
+            new, newTime, newPeak = measure(O3METER.darkPixelsMean, arr, args.repeat)
+            same = "identical" if old == new else "MISMATCH %s != %s" % (old, new)
+            if old != new:
+                status = 1
+            print("%8g %7s %12.3f %12.3f %12.1f %12.1f  %s" % (mp, bright, oldTime, newTime,
+                  oldPeak / 2**20, newPeak / 2**20, same))
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
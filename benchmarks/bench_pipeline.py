@@ -0,0 +1,307 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# O3METER
+# Copyright (C) 2018 Orlando Garcia-Feal - Universidade de Vigo - orlando@uvigo.es
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+################################################################################
+#
+# Benchmark and regression checks of the measurement pipeline.
+#
+# Synthetic stripe photographs (see bench_kernel.stripeImage) are written as
+# PNG and JPEG files and as 8 and 16 bit PPM streams standing in for the
+# output of dcraw, and every stage of the pipeline is timed on them:
+#
+#   decode    file to QImage (the PPM streams through readPPM)
+#   array     QImage to numpy array (imageToArray)
+#   hue       histogram, mean of the darker pixels and Ozone Scale value
+#   integral  integral image and REGIONS region means
+#   heatmap   tile means and their Ozone Scale values
+#   strips    strip detection and measurement
+#
+# Every stage runs in a new child process once its input is ready, so the
+# peak RSS growth reported belongs to the stage alone (on Linux; elsewhere it
+# is the peak of the whole child). Allocations are the peak traced by
+# tracemalloc: numpy arrays, but not the buffers of the QImages.
+#
+# With --check, small synthetic pictures are measured instead and the results
+# are compared with the golden values in golden.json, and with the original
+# implementations (numpy mean of the darker pixels, numpy mean of regions,
+# QColor hues), so performance work can not silently change the readings.
+# --update-golden rewrites golden.json after an intended change.
+#
+#   benchmarks/bench_pipeline.py [--megapixels 1 12 24 50] [--repeat 3] [--stages STAGE ...]
+#   benchmarks/bench_pipeline.py --check [--update-golden]
+#
+import sys, os, time, argparse, tempfile, tracemalloc, resource, json, hashlib
+import multiprocessing, concurrent.futures
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import O3METER
+from bench_kernel import legacyDarkPixelsMean, stripeImage
+
+from PyQt5.QtGui import QColor
+
+FORMATS = ['png', 'jpg', 'ppm8', 'ppm16']
+STAGES = ['decode', 'array', 'hue', 'integral', 'heatmap', 'strips']
+REGIONS = 1000
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden.json')
+
+## Writes a picture as a binary PPM stream, like dcraw does.
+# @param arr numpy array with the image data (BGR)
+# @param maxval 255 or 65535
+def writePPM(arr, fileName, maxval=255):
+    rgb = arr[:, :, 2::-1]
+    if maxval > 255 :
+        rgb = (rgb.astype(numpy.uint16) * 257).astype('>u2')
+    with open(fileName, 'wb') as f:
+        f.write(b"P6\n%d %d\n%d\n" % (arr.shape[1], arr.shape[0], maxval))
+        f.write(numpy.ascontiguousarray(rgb).tobytes())
+
+## Writes a picture in all the formats.
+# @param arr numpy array with the image data (BGR)
+# @param directory where the files are written
+# @returns dictionary with the file name of every format
+def writeFiles(arr, directory):
+    files = {fmt: os.path.join(directory, "stripes" + fmt[3:] + "." + fmt[:3]) for fmt in FORMATS}
+    image = O3METER.arrayToImage(arr)
+    image.save(files['png'])
+    image.save(files['jpg'], quality=95)
+    writePPM(arr, files['ppm8'], 255)
+    writePPM(arr, files['ppm16'], 65535)
+    return files
+
+## Decodes a file like the viewer does, reading PPM files as dcraw output.
+# @returns QImage
+def decode(fileName):
+    if fileName.endswith('.ppm'):
+        with open(fileName, 'rb') as f:
+            return O3METER.readPPM(f)[0]
+    return O3METER.decodeImage(fileName)
+
+## Synthetic photograph: light background with three noisy strips of different
+# hues, from pink to yellowish, as those of real ozone test strips.
+# @param megapixels size of the image
+# @returns BGRA numpy array
+def colorStripeImage(megapixels, seed=0):
+    rng = numpy.random.default_rng(seed)
+    arr = stripeImage(megapixels, seed=seed)
+    height, width = arr.shape[:2]
+    for k, bgr in enumerate(((120, 60, 140), (90, 70, 120), (40, 90, 110))):
+        x0 = width // 8 + k * width // 4
+        stripe = arr[height // 6:5 * height // 6, x0:x0 + width // 8, :3]
+        stripe[...] = numpy.array(bgr, dtype=numpy.uint8) + rng.integers(0, 20, size=stripe.shape, dtype=numpy.uint8)
+    return arr
+
+## Random rectangles (x0, y0, x1, y1) inside an image.
+def randomRegions(width, height, count, seed=0):
+    rng = numpy.random.default_rng(seed)
+    xs = numpy.sort(rng.integers(0, width + 1, size=(count, 2)), axis=1)
+    ys = numpy.sort(rng.integers(0, height + 1, size=(count, 2)), axis=1)
+    return [(int(x0), int(y0), int(x1) + 1, int(y1) + 1) for (x0, x1), (y0, y1) in zip(xs, ys)]
+
+## Measures the whole picture.
+# @returns dictionary with the Ozone Scale value and the mean color
+def measureWhole(arr):
+    rMean, gMean, bMean, nvals = O3METER.ChannelHistogram.fromArray(arr).darkMean()
+    return {'scale': O3METER.HueScale.rgbToScale(rMean, gMean, bMean), 'red': rMean,
+            'green': gMean, 'blue': bMean, 'pixels': nvals}
+
+def regionMeans(arr):
+    integral = O3METER.IntegralImage(arr)
+    return [integral.mean(*region) for region in randomRegions(arr.shape[1], arr.shape[0], REGIONS)]
+
+def heatmap(integral):
+    rMeans, gMeans, bMeans, counts = integral.tileMeans(64)
+    return O3METER.HueScale.rgbToScale(rMeans, gMeans, bMeans)
+
+STAGE_FUNCTIONS = {
+    'decode': decode,
+    'array': O3METER.imageToArray,
+    'hue': measureWhole,
+    'integral': regionMeans,
+    'heatmap': heatmap,
+    'strips': O3METER.measureStrips,
+}
+
+## Builds the input of a stage running the stages before it.
+def stageInput(stage, fileName):
+    if stage == 'decode' :
+        return fileName
+    image = decode(fileName)
+    if stage == 'array' :
+        return image
+    arr = O3METER.imageToArray(image)
+    if stage == 'heatmap' :
+        return O3METER.IntegralImage(arr)
+    return arr
+
+## Resident set size of this process, current and peak, in bytes. The peak is
+# reset if resetPeak is given (only possible on Linux).
+def rss(resetPeak=False):
+    try:
+        if resetPeak :
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform == 'darwin' else 1024
+        return peak, peak
+
+## Runs a stage in the current process.
+# @returns tuple with the best wall time, the peak RSS growth and the peak of
+# the allocations traced by tracemalloc
+def runStage(stage, fileName, repeat):
+    data = stageInput(stage, fileName)
+    function = STAGE_FUNCTIONS[stage]
+
+    base = rss(resetPeak=True)[0]
+    start = time.perf_counter()
+    function(data)
+    best = time.perf_counter() - start
+    peak = rss()[1] - base
+
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        function(data)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(data)
+    traced = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, traced
+
+## Benchmarks every stage on every format at the given sizes.
+# @returns exit status
+def benchmark(megapixels, stages, repeat):
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    print("%6s %6s %9s %10s %10s %10s" % ("MP", "format", "stage", "time s", "RSS MiB", "alloc MiB"))
+    with tempfile.TemporaryDirectory() as directory:
+        for mp in megapixels:
+            files = writeFiles(stripeImage(mp), directory)
+            for fmt in FORMATS:
+                for stage in stages:
+                    # A new process for every stage
+                    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+                        best, peak, traced = pool.submit(runStage, stage, files[fmt], repeat).result()
+                    print("%6g %6s %9s %10.3f %10.1f %10.1f" % (mp, fmt, stage, best, peak / 2**20, traced / 2**20))
+                    sys.stdout.flush()
+    return 0
+
+## Computes the values compared with golden.json, and compares the pipeline
+# with the original implementations.
+# @param failures list where the differences with the originals are appended
+# @returns dictionary with the values
+def checkValues(failures):
+    values = {}
+
+    # Whole pictures, regions, tiles and strips of synthetic pictures. JPEG
+    # files are left out, as they depend on the version of libjpeg.
+    with tempfile.TemporaryDirectory() as directory:
+        for name, source in (('gray', stripeImage(0.25, seed=1)), ('bright', stripeImage(0.25, True, seed=1)),
+                             ('colors', colorStripeImage(0.25, seed=1))):
+            files = writeFiles(source, directory)
+            for fmt in ('png', 'ppm8', 'ppm16'):
+                arr = O3METER.imageToArray(decode(files[fmt]))
+                if not numpy.array_equal(arr, source[:, :, :3]):
+                    failures.append(name + "/" + fmt + ": decoded picture differs from the source")
+                whole = measureWhole(arr)
+                values[name + "/" + fmt] = whole
+
+                legacy = legacyDarkPixelsMean(arr)
+                if legacy != (whole['red'], whole['green'], whole['blue'], whole['pixels']):
+                    failures.append(name + "/" + fmt + ": darker pixels mean %s, original %s" % (whole, legacy))
+
+            means = regionMeans(arr)
+            for region, mean in zip(randomRegions(arr.shape[1], arr.shape[0], REGIONS), means):
+                xo, yo, xd, yd = region
+                block = arr[yo:yd, xo:xd]
+                original = tuple(int(block[:, :, channel].mean()) for channel in (2, 1, 0)) + (block.shape[0] * block.shape[1],)
+                if mean != original :
+                    failures.append(name + ": region %s mean %s, original %s" % (region, mean, original))
+                    break
+            values[name + "/regions"] = hashlib.sha256(json.dumps(means).encode()).hexdigest()
+
+            integral = O3METER.IntegralImage(arr)
+            for tile in (64, 50):
+                tiles = numpy.stack(integral.tileMeans(tile)[:3], axis=-1)
+                for ty in range(tiles.shape[0]):
+                    for tx in range(tiles.shape[1]):
+                        block = arr[ty * tile:(ty + 1) * tile, tx * tile:(tx + 1) * tile]
+                        original = [int(block[:, :, channel].mean()) for channel in (2, 1, 0)]
+                        if list(tiles[ty, tx]) != original :
+                            failures.append(name + ": tile %d (%d, %d) mean %s, original %s"
+                                            % (tile, tx, ty, list(tiles[ty, tx]), original))
+            values[name + "/heatmap"] = hashlib.sha256(heatmap(integral).astype(numpy.int16).tobytes()).hexdigest()
+            values[name + "/strips"] = [{k: list(v) if k == 'region' else v for k, v in strip.items()
+                                         if k != 'thresholds'} for strip in O3METER.measureStrips(arr)]
+
+    # Ozone Scale of a grid of colors against the hues of QColor
+    levels = numpy.arange(0, 256, 5)
+    r, g, b = (c.reshape(-1) for c in numpy.meshgrid(levels, levels, levels, indexing='ij'))
+    scales = O3METER.HueScale.rgbToScale(r, g, b)
+    for red, green, blue, scale in zip(r.tolist(), g.tolist(), b.tolist(), scales.tolist()):
+        original = O3METER.HueScale.hueToScale(QColor(red, green, blue).hue())
+        if scale != original :
+            failures.append("color (%d, %d, %d): scale %d, QColor %d" % (red, green, blue, scale, original))
+            break
+    values['hue grid'] = hashlib.sha256(scales.astype(numpy.int16).tobytes()).hexdigest()
+    return values
+
+## Checks the readings against golden.json and the original implementations.
+# @param update rewrite golden.json with the current values
+# @returns exit status
+def check(update):
+    failures = []
+    values = checkValues(failures)
+
+    if update :
+        with open(GOLDEN, 'w') as f:
+            json.dump(values, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print("Golden values written to " + GOLDEN)
+    else:
+        with open(GOLDEN) as f:
+            golden = json.load(f)
+        for name in sorted(set(golden) | set(values)):
+            if golden.get(name) != values.get(name):
+                failures.append(name + ": %s, golden %s" % (values.get(name), golden.get(name)))
+
+    for failure in failures:
+        print("MISMATCH " + failure)
+    print("%d values checked, %d mismatches" % (len(values), len(failures)))
+    return 1 if failures else 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark and regression checks of the measurement pipeline.")
+    parser.add_argument("--megapixels", type=float, nargs='+', default=[1, 12, 24, 50])
+    parser.add_argument("--stages", nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--check", action='store_true', help="compare the readings with the golden values")
+    parser.add_argument("--update-golden", action='store_true', help="rewrite the golden values")
+    args = parser.parse_args(argv)
+
+    if args.check or args.update_golden :
+        return check(args.update_golden)
+    return benchmark(args.megapixels, args.stages, args.repeat)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
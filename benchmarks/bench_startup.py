@@ -0,0 +1,134 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# O3METER
+# Copyright (C) 2018 Orlando Garcia-Feal - Universidade de Vigo - orlando@uvigo.es
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+################################################################################
+#
+# Benchmark of the cold start of the entry points.
+#
+# Every entry point runs in a new interpreter, so nothing is shared with the
+# previous runs but the page cache of the operating system, and the best wall
+# time of --repeat runs is reported:
+#
+#   core      import o3core
+#   profiles  O3METER.py profiles
+#   query     O3METER.py query on an empty store
+#   batch     O3METER.py batch on a small PPM and a small PNG file
+#   pool      start a pool of --jobs batch workers and run a task in each one
+#   gui       build the QApplication and the MainWindow (offscreen) and quit
+#
+# The heavy modules each entry point loaded (numpy, QtGui, QtWidgets) are
+# listed too, taken from a run with -X importtime.
+#
+#   benchmarks/bench_startup.py [--repeat 5] [--jobs 4] [--entries ENTRY ...]
+#
+import sys, os, time, argparse, tempfile, subprocess
+import numpy
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+PROGRAM = os.path.join(ROOT, 'O3METER.py')
+ENTRIES = ['core', 'profiles', 'query', 'batch', 'pool', 'gui']
+MODULES = ['numpy', 'PyQt5.QtGui', 'PyQt5.QtWidgets']
+
+POOL = """
+import sys, os, concurrent.futures
+sys.path.insert(0, %r)
+from o3batch import *
+if __name__ == '__main__':
+    with concurrent.futures.ProcessPoolExecutor(%d, mp_context=workerContext(), initializer=openWorkerCache,
+                                                initargs=(None,)) as pool:
+        [future.result() for future in [pool.submit(os.getpid) for i in range(%d)]]
+"""
+
+GUI = """
+import sys
+sys.path.insert(0, %r)
+from o3gui import *
+app = QApplication(sys.argv)
+window = MainWindow()
+window.jobs.shutdown()
+"""
+
+## Writes the pictures measured by the batch entry point.
+# @param directory where the files are written
+# @returns list of file names
+def writeFiles(directory):
+    arr = numpy.full((120, 160, 3), 200, dtype=numpy.uint8)
+    arr[20:100, 40:120] = (140, 40, 90)
+    ppm = os.path.join(directory, "stripe.ppm")
+    with open(ppm, 'wb') as f:
+        f.write(b"P6\n160 120\n255\n" + numpy.ascontiguousarray(arr[:, :, 2::-1]).tobytes())
+    # The PNG is written by the program itself, so Qt is not loaded here
+    png = os.path.join(directory, "stripe.png")
+    subprocess.run([sys.executable, '-c', "import sys; sys.path.insert(0, %r); import o3core; "
+                    "o3core.readPPM(open(%r, 'rb'))[0].save(%r)" % (ROOT, ppm, png)], check=True)
+    return [ppm, png]
+
+## Command line of every entry point.
+# @param directory scratch directory of the benchmark
+# @param jobs number of pool workers
+# @returns dictionary of lists of arguments
+def commands(directory, jobs):
+    store = os.path.join(directory, "measurements.sqlite")
+    subprocess.run([sys.executable, '-c', "import sys; sys.path.insert(0, %r); import o3core; "
+                    "o3core.MeasurementStore(%r).close()" % (ROOT, store)], check=True)
+    return {'core': [sys.executable, '-c', "import sys; sys.path.insert(0, %r); import o3core" % ROOT],
+            'profiles': [sys.executable, PROGRAM, 'profiles'],
+            'query': [sys.executable, PROGRAM, 'query', '--store', store],
+            'batch': [sys.executable, PROGRAM, 'batch', '--no-cache'] + writeFiles(directory),
+            'pool': [sys.executable, '-c', POOL % (ROOT, jobs, jobs)],
+            'gui': [sys.executable, '-c', GUI % ROOT]}
+
+## Runs an entry point.
+# @param command list of arguments
+# @param repeat number of runs
+# @returns tuple with the best wall time and the list of the MODULES loaded
+def runEntry(command, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best == None else min(best, elapsed)
+
+    trace = subprocess.run([command[0], '-X', 'importtime'] + command[1:], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    imported = {line.rsplit('|', 1)[-1].strip() for line in trace.splitlines() if line.startswith('import time:')}
+    return best, [module for module in MODULES if module in imported]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark of the cold start of the entry points.")
+    parser.add_argument("--entries", nargs='+', choices=ENTRIES, default=ENTRIES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--jobs", type=int, default=4, help="workers of the pool entry point")
+    args = parser.parse_args(argv)
+
+    # The viewer must not need a display
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['XDG_CACHE_HOME'] = os.environ['XDG_DATA_HOME'] = directory
+        entries = commands(directory, args.jobs)
+        print("%9s %8s  %s" % ("entry", "time s", "modules"))
+        for entry in args.entries:
+            best, modules = runEntry(entries[entry], args.repeat)
+            print("%9s %8.3f  %s" % (entry, best, " ".join(modules) or "-"))
+            sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
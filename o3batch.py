@@ -0,0 +1,1076 @@
+# -*- coding: utf-8 -*-
+
+# O3METER
+# Copyright (C) 2018 Orlando Garcia-Feal - Universidade de Vigo - orlando@uvigo.es
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##
+# Headless subcommands of O3METER (batch, calibrate, profiles, query, report,
+# watch).
+#
+
+import sys, os, time, datetime, argparse, csv, json, sqlite3, multiprocessing
+import select, signal, struct, ctypes, ctypes.util, collections, concurrent.futures, functools
+import numpy
+
+import o3core
+from o3core import *
+
+################################################################################
+#
+# Headless batch processing.
+#
+# Measures every photograph found in a directory tree without the graphical
+# interface: no QApplication is ever constructed, Qt is only used to decode the
+# images. The files are distributed among a pool of worker processes and the
+# results are written as CSV or JSON. Every worker decodes its own RAW files
+# (with LibRaw, or running its own dcraw), so several are decoded
+# concurrently. With --strips every strip of the pictures is detected and
+# measured on its own, one row per strip.
+#
+#   O3METER.py batch DIR [DIR ...] [--jobs N] [--output FILE] [--format csv|json] [--strips]
+#
+# With --fast the pictures are only estimated from a reduced version of them,
+# and measured again at full resolution when the estimate is close to one of
+# the --decision thresholds (see the calibrate subcommand).
+#
+BATCH_FIELDS = ['file', 'scale', 'red', 'green', 'blue', 'pixels', 'error']
+STRIP_FIELDS = ['file', 'strip', 'x0', 'y0', 'x1', 'y1', 'scale', 'red', 'green', 'blue', 'pixels', 'error']
+FAST_FIELDS = ['file', 'scale', 'red', 'green', 'blue', 'pixels', 'estimate', 'bound', 'error']
+
+## Finds all the supported pictures in a directory tree.
+# @param paths list of directories or files
+# @returns sorted list of file names
+def findImages(paths):
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            for name in names:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    files.append(os.path.join(root, name))
+    return sorted(files)
+
+## Decodes a picture into an array, through the spool of the batch workers if
+# there is one (see openWorkerCache).
+# @param fileName name of the file
+# @param dropAlpha see ImageBuffer, spooled pictures never have alpha
+# @returns numpy array (BGR) with the picture
+def decodeArray(fileName, dropAlpha=True):
+    if workerSpool != None :
+        return workerSpool.array(fileName)
+    return imageToArray(decodeImage(fileName), dropAlpha)
+
+## Measures a file from its histogram with the current profile. Like
+# measureFile, it never raises.
+# @param fileName name of the file
+# @param hist ChannelHistogram of the picture
+# @param weight see ChannelHistogram.darkMean
+# @param fields fields of the result
+# @returns dictionary with the fields listed in fields
+def scoreHistogram(fileName, hist, weight=1, fields=BATCH_FIELDS):
+    result = dict.fromkeys(fields, '')
+    result['file'] = fileName
+    try:
+        result.update(o3core.PROFILE.measure(hist, weight))
+    except ValueError as e:
+        result['error'] = str(e)
+    return result
+
+## Measures a single file. This is the work unit of the batch workers, so it
+# never raises: errors are reported in the result.
+# @param fileName name of the file
+# @returns dictionary with the fields listed in BATCH_FIELDS, and the
+# ChannelHistogram of the picture ('histogram') if it was decoded
+def measureFile(fileName):
+    try:
+        if fileName.lower().endswith(RAW_EXTENSIONS) and workerSpool == None :
+            # The RAW data is measured as it is decoded, without storing it
+            hist = readRaw(fileName, keepImage=False)[1]
+        else:
+            hist = ChannelHistogram.fromArray(decodeArray(fileName, dropAlpha=False))
+    except Exception as e:
+        result = dict.fromkeys(BATCH_FIELDS, '')
+        result['file'] = fileName
+        result['error'] = str(e) or type(e).__name__
+        return result
+    result = scoreHistogram(fileName, hist)
+    result['histogram'] = hist
+    return result
+
+## Estimates the measurement of a single file from a reduced picture. RAW
+# files are decoded at half size, JPEG pictures are decoded by libjpeg
+# directly at 1/factor of their size and the other pictures are decoded whole
+# but only one pixel every factor rows and columns is taken. Like
+# measureFile, it never raises.
+# @param fileName name of the file
+# @param factor reduction factor of the sides of the picture
+# @returns dictionary with the fields listed in FAST_FIELDS, 'pixels' being
+# the estimated number of pixels of the whole picture
+@STATS.timed('estimate')
+def estimateFile(fileName, factor):
+    try:
+        if fileName.lower().endswith(RAW_EXTENSIONS):
+            # RAW files cannot be decoded smaller than half size
+            hist = readRaw(fileName, keepImage=False, halfSize=True)[1]
+            weight = 4
+        else:
+            from PyQt5.QtCore import QSize
+            from PyQt5.QtGui import QImageReader
+            reader = QImageReader(fileName)
+            reader.setAutoTransform(True)
+            size = reader.size()
+            scaled = reader.format() == b'jpeg' and size.isValid() and factor > 1
+            if scaled :
+                reader.setScaledSize(QSize(max(1, size.width() // factor), max(1, size.height() // factor)))
+            image = reader.read()
+            if image.isNull():
+                raise RuntimeError(reader.errorString())
+            arr = imageToArray(image, dropAlpha=False)
+            if not scaled :
+                size = image.size()
+                arr = arr[::factor, ::factor]
+            hist = ChannelHistogram.fromArray(arr)
+            weight = size.width() * size.height() / max(1, arr.shape[0] * arr.shape[1])
+    except Exception as e:
+        result = dict.fromkeys(FAST_FIELDS, '')
+        result['file'] = fileName
+        result['error'] = str(e) or type(e).__name__
+    else:
+        result = scoreHistogram(fileName, hist, weight, FAST_FIELDS)
+    result['estimate'] = 1
+    return result
+
+## Detects and measures the strips of a single file. Like measureFile, it
+# never raises.
+# @param fileName name of the file
+# @returns list of tuples with a dictionary with the fields listed in
+# STRIP_FIELDS (plus those needed by MeasurementStore.add) and None, the
+# same as batchWorker, as the results of the strips are not cached
+def stripsWorker(fileName):
+    try:
+        strips = measureStrips(decodeArray(fileName))
+    except Exception as e:
+        result = dict.fromkeys(STRIP_FIELDS, '')
+        result['file'] = fileName
+        result['error'] = str(e) or type(e).__name__
+        return [(result, None)]
+
+    results = []
+    for i, strip in enumerate(strips):
+        result = dict.fromkeys(STRIP_FIELDS, '')
+        result.update(strip)
+        result['file'] = fileName
+        result['strip'] = i + 1
+        result['x0'], result['y0'], result['x1'], result['y1'] = strip['region']
+        results.append((result, None))
+    if not results :
+        result = dict.fromkeys(STRIP_FIELDS, '')
+        result['file'] = fileName
+        result['error'] = "no strips found"
+        results.append((result, None))
+    return results
+
+## Runs a batch work unit and returns its results together with the
+# statistics gathered meanwhile, so the main process can add them up.
+# @param worker batchWorker or stripsWorker
+# @param fileName name of the file
+# @returns tuple with the results of the worker and a Stats snapshot
+def withStats(worker, fileName):
+    results = worker(fileName)
+    return results, STATS.take()
+
+## Context of the batch worker processes. LibRaw uses OpenMP, which can
+# deadlock in a process forked after it was used, so when it is available the
+# workers are forked from a server process instead of the main one. The server
+# imports this module once, so the workers start with it already loaded.
+def workerContext():
+    if rawDecoder() != 'libraw' :
+        return multiprocessing.get_context()
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+## Cache and spool of the batch worker processes, see openWorkerCache.
+workerCache = None
+workerSpool = None
+
+## Initializes a batch worker process.
+# @param cachePath cache database, or None to disable the cache
+# @param spoolPath directory of the DecodedSpool, or None to decode the
+# pictures every time
+# @param profile Profile to measure with (default: keep the current one)
+def openWorkerCache(cachePath, spoolPath=None, profile=None):
+    global workerCache, workerSpool
+    workerCache = ResultCache(cachePath) if cachePath else None
+    workerSpool = DecodedSpool(spoolPath) if spoolPath else None
+    if profile != None :
+        setProfile(profile)
+
+## Initializer of the watch worker processes. Ctrl+C sends SIGINT to the whole
+# process group, so the workers ignore it and leave the shutdown to the main
+# process, which finishes the pictures being measured. Batch workers keep it,
+# so that Ctrl+C stops a batch run at once. The parameters are those of
+# openWorkerCache.
+def initWatchWorker(cachePath, spoolPath=None, profile=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    openWorkerCache(cachePath, spoolPath, profile)
+
+## Looks up a file in the cache of the worker: its result with the current
+# profile or, failing that, its histogram, from which it is measured without
+# decoding the picture.
+# @param fileName name of the file
+# @param fields fields of the result
+# @returns tuple with the result (None if the picture has to be measured) and
+# its cache key (None if the cache is disabled). A cached result has the
+# 'cached' flag, and the main process updates the access time of its entry
+# (see storeResult).
+def lookupFile(fileName, fields=BATCH_FIELDS):
+    if workerCache == None :
+        return None, None
+    try:
+        key = ResultCache.profileKey(workerCache.digest(fileName))
+        cached = workerCache.get(key, touch=False)
+        hist = workerCache.histogram(ResultCache.keyDigest(key), touch=False) if cached == None else None
+    except (OSError, sqlite3.Error):
+        return None, None
+    if cached != None :
+        result = dict.fromkeys(fields, '')
+        result.update(cached)
+        result['file'] = fileName
+        result['cached'] = True
+        return result, key
+    if hist != None :
+        STATS.count('rescored')
+        return scoreHistogram(fileName, hist, fields=fields), key
+    return None, key
+
+## Work unit of the batch workers: returns the cached result of a file or
+# measures it, from its cached histogram if there is one (see lookupFile).
+# Storing new results and updating the access times is left to the main
+# process (see storeResult), so the workers only read the cache and never
+# wait for its write lock.
+# @param fileName name of the file
+# @returns tuple with the result and its cache key, see lookupFile
+def batchWorker(fileName):
+    result, key = lookupFile(fileName)
+    if result == None :
+        result = measureFile(fileName)
+    return result, key
+
+## Work unit of the batch workers in fast mode: returns the cached result of a
+# file, or estimates it and measures it at full resolution only if the
+# estimate is within margin of a decision threshold. Estimates are never
+# cached, and are stored flagged as such (see MeasurementStore.add).
+# @param fileName name of the file
+# @param factor reduction factor, see estimateFile
+# @param decisions list of decision thresholds (Ozone Scale values)
+# @param margin largest expected deviation of the estimates, reported as
+# their 'bound' (None if unknown, then only an estimate right on a threshold
+# is measured again)
+# @returns tuple with the result (fields in FAST_FIELDS) and its cache key
+# (None for an estimate), as batchWorker
+def fastWorker(fileName, factor=4, decisions=(), margin=None):
+    result, key = lookupFile(fileName, FAST_FIELDS)
+    if result != None :
+        result['estimate'] = result['bound'] = 0
+        return result, key
+
+    result = estimateFile(fileName, factor)
+    result['bound'] = '' if margin == None else margin
+    if result['error'] or not any(abs(result['scale'] - t) <= (margin or 0) for t in decisions):
+        return result, None
+
+    STATS.count('full measurements')
+    result = dict.fromkeys(FAST_FIELDS, '')
+    result.update(measureFile(fileName))
+    result['estimate'] = result['bound'] = 0
+    return result, key
+
+## Stores the result of a worker in the cache of the main process, or, if it
+# was taken from the cache, queues its key to update the access time of the
+# entry and of the histogram of the file.
+# @param cache ResultCache
+# @param result result of the worker, whose 'cached' flag is removed
+# @param key its cache key (None if it is not to be cached)
+# @param touched list of the keys whose access time is to be updated, see
+# ResultCache.touch
+def storeResult(cache, result, key, touched):
+    cached = result.pop('cached', False)
+    if key == None :
+        return
+    if not cached :
+        cache.put(key, result)
+    if result.get('histogram') != None :
+        cache.putHistogram(ResultCache.keyDigest(key), result['histogram'], result['file'])
+    else:
+        # Taken from the cache or measured from a cached histogram
+        touched.append(key)
+
+## Default location of the calibration of the fast mode.
+def calibrationPath():
+    base = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(base, 'o3meter', 'calibration.json')
+
+## Reads the calibration of the fast mode written by the calibrate subcommand.
+# @param path calibration file
+# @returns dictionary with the deviations of every reduction factor (keyed by
+# the factor as a string), empty if there is no calibration or it was made
+# with another profile
+def loadCalibration(path):
+    try:
+        with open(path) as f:
+            calibration = json.load(f)
+        if calibration.get('profile') != o3core.PROFILE.values() :
+            return {}
+        return calibration.get('factors', {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+## Adds the --profile option to the parser of a subcommand. The profile is
+# loaded and made the current one while parsing.
+def addProfileArgument(parser):
+    def load(name):
+        try:
+            profile = Profile.load(name)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+        setProfile(profile)
+        return profile
+    parser.add_argument("--profile", type=load, default=Profile.defaultName(), metavar="NAME",
+                        help="measurement profile, name or file (default: $O3METER_PROFILE or default)")
+
+## Adds the options of the fast mode to the parser of a subcommand.
+def addFastArguments(parser):
+    parser.add_argument("--fast", type=int, nargs='?', const=4, metavar="FACTOR",
+                        help="estimate the values from the pictures reduced by FACTOR (default: 4)")
+    parser.add_argument("--decision", type=int, nargs='+', default=[], metavar="T",
+                        help="measure at full resolution the pictures whose estimate is close to these values")
+    parser.add_argument("--margin", type=float, metavar="M",
+                        help="largest deviation of the estimates (default: the calibrated one)")
+    parser.add_argument("--calibration", metavar="FILE", default=calibrationPath(),
+                        help="calibration of the fast mode (default: %(default)s)")
+
+## Builds the fast mode worker for the options given.
+# @param args parsed options, see addFastArguments
+# @returns fastWorker with its parameters bound
+def fastOptions(args):
+    if args.fast < 1 :
+        raise SystemExit("The reduction factor must be 1 or more")
+    margin = args.margin
+    if margin == None :
+        calibration = loadCalibration(args.calibration).get(str(args.fast))
+        if calibration != None :
+            margin = calibration['max']
+        elif args.decision :
+            print("No calibration for a factor of " + str(args.fast) + " in " + args.calibration
+                  + ", only estimates on a decision threshold are measured again", file=sys.stderr)
+    return functools.partial(fastWorker, factor=args.fast, decisions=args.decision, margin=margin)
+
+## Writes the batch results.
+# @param results iterable of result dictionaries
+# @param out file object
+# @param fmt 'csv' or 'json'
+# @param fields fields written, other keys of the results are ignored
+def writeResults(results, out, fmt, fields=BATCH_FIELDS):
+    if fmt == 'json':
+        json.dump([{f: result[f] for f in fields} for result in results], out, indent=1)
+        out.write("\n")
+        return
+    writer = csv.DictWriter(out, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+    for result in results:
+        writer.writerow(result)
+        out.flush()
+
+## Entry point of the batch subcommand.
+# @param argv command line arguments
+# @returns exit status
+def batchMain(argv):
+    parser = argparse.ArgumentParser(prog="O3METER.py batch",
+                                     description="Measure all the pictures in a directory tree.")
+    parser.add_argument("paths", nargs='+', metavar="DIR", help="directories or files to process")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("-o", "--output", help="output file (default: standard output)")
+    parser.add_argument("-f", "--format", choices=['csv', 'json'],
+                        help="output format (default: guessed from the output file, csv otherwise)")
+    parser.add_argument("--cache", metavar="FILE", default=ResultCache.defaultPath(),
+                        help="results cache (default: %(default)s)")
+    parser.add_argument("--no-cache", dest='cache', action='store_const', const=None,
+                        help="do not use the results cache")
+    parser.add_argument("--store", metavar="FILE", nargs='?', const=MeasurementStore.defaultPath(),
+                        help="also save the measurements in the store (default file: %(const)s)")
+    parser.add_argument("--station", help="station recorded in the store (default: $O3METER_STATION or the host name)")
+    parser.add_argument("--strips", action='store_true',
+                        help="detect the strips of every picture and measure each of them")
+    addProfileArgument(parser)
+    parser.add_argument("--spool", metavar="DIR", nargs='?', const=DecodedSpool.defaultPath(),
+                        help="keep the decoded pictures to analyse them again faster (default directory: %(const)s)")
+    addFastArguments(parser)
+    parser.add_argument("--stats", metavar="FILE",
+                        help="write timings and counters of the processing as JSON ('-' for standard error)")
+    args = parser.parse_args(argv)
+    if args.strips and args.fast != None :
+        parser.error("--strips and --fast cannot be used together")
+    start = time.perf_counter()
+
+    fmt = args.format
+    if fmt == None :
+        fmt = 'json' if args.output and args.output.lower().endswith('.json') else 'csv'
+
+    files = findImages(args.paths)
+    if not files:
+        print("No pictures found", file=sys.stderr)
+        return 1
+
+    if args.strips :
+        # Strips are always measured on the decoded picture
+        args.cache = None
+    fields = STRIP_FIELDS if args.strips else BATCH_FIELDS
+    worker = batchWorker
+    if args.strips :
+        worker = stripsWorker
+    elif args.fast != None :
+        worker = fastOptions(args)
+        fields = FAST_FIELDS
+
+    cache = None
+    if args.cache :
+        try:
+            cache = ResultCache(args.cache)
+        except (OSError, sqlite3.Error) as e:
+            print("Cache disabled: " + str(e), file=sys.stderr)
+            args.cache = None
+
+    store = MeasurementStore(args.store, args.station) if args.store else None
+
+    # Both workers give lists of results for every file
+    def run(mapper, **kwargs):
+        for results, stats in mapper(functools.partial(withStats, worker), files, **kwargs):
+            STATS.merge(stats)
+            yield results if args.strips else [results]
+
+    failed = []
+    touched = []
+    def collect(results):
+        for result, key in (pair for pairs in results for pair in pairs):
+            if result['error']:
+                failed.append(result['file'])
+                print(result['file'] + ": " + result['error'], file=sys.stderr)
+                yield result
+                continue
+            storeResult(cache, result, key, touched)
+            # The access times are updated in batches
+            if len(touched) >= 256 :
+                cache.touch(touched)
+                del touched[:]
+            if store != None :
+                store.add(result['file'], result)
+            yield result
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.jobs <= 1:
+            openWorkerCache(args.cache, args.spool, args.profile)
+            writeResults(collect(run(map)), out, fmt, fields)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=workerContext(),
+                                                        initializer=openWorkerCache,
+                                                        initargs=(args.cache, args.spool, args.profile)) as pool:
+                chunksize = max(1, min(16, len(files) // (args.jobs * 4)))
+                writeResults(collect(run(pool.map, chunksize=chunksize)), out, fmt, fields)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if cache != None :
+            cache.touch(touched)
+            cache.close()
+        if store != None :
+            store.close()
+        if args.stats :
+            STATS.dump(args.stats, files=len(files), failed=len(failed), jobs=args.jobs,
+                       seconds=time.perf_counter() - start)
+
+    return 1 if failed else 0
+
+## Work unit of the calibration: measures a file at full resolution and
+# estimates it with every reduction factor, timing each of them.
+# @param fileName name of the file
+# @param factors reduction factors
+# @returns dictionary with the file name, the error if any and, for 'full'
+# and every factor, a tuple with the Ozone Scale value and the seconds taken
+def calibrateWorker(fileName, factors=(2, 4, 8)):
+    entry = {'file': fileName, 'error': ''}
+    for factor in ['full'] + list(factors):
+        start = time.perf_counter()
+        result = measureFile(fileName) if factor == 'full' else estimateFile(fileName, factor)
+        if result['error']:
+            entry['error'] = result['error']
+            break
+        entry[factor] = (result['scale'], time.perf_counter() - start)
+    return entry
+
+## Entry point of the calibrate subcommand: compares the estimates of the fast
+# mode with the full resolution values on a set of pictures, prints the
+# deviations and the speed up of every reduction factor and saves them as the
+# margins used by default by --fast.
+# @param argv command line arguments
+# @returns exit status
+def calibrateMain(argv):
+    parser = argparse.ArgumentParser(prog="O3METER.py calibrate",
+                                     description="Measure how far the estimates of the fast mode are "
+                                                 "from the full resolution values.")
+    parser.add_argument("paths", nargs='+', metavar="DIR", help="directories or files of the calibration set")
+    parser.add_argument("--factors", type=int, nargs='+', default=[2, 4, 8], metavar="FACTOR",
+                        help="reduction factors to calibrate (default: 2 4 8)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("-o", "--output", default=calibrationPath(),
+                        help="calibration file written (default: %(default)s)")
+    addProfileArgument(parser)
+    args = parser.parse_args(argv)
+    if min(args.factors) < 1 :
+        parser.error("the reduction factors must be 1 or more")
+
+    files = findImages(args.paths)
+    if not files:
+        print("No pictures found", file=sys.stderr)
+        return 1
+
+    worker = functools.partial(calibrateWorker, factors=args.factors)
+    if args.jobs <= 1:
+        entries = list(map(worker, files))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=workerContext(),
+                                                    initializer=setProfile, initargs=(args.profile,)) as pool:
+            entries = list(pool.map(worker, files))
+
+    measured = []
+    for entry in entries:
+        if entry['error']:
+            print(entry['file'] + ": " + entry['error'], file=sys.stderr)
+        else:
+            measured.append(entry)
+    if not measured :
+        print("No pictures could be measured", file=sys.stderr)
+        return 1
+
+    full = numpy.array([entry['full'] for entry in measured])
+    factors = {}
+    print("factor   mean    p95    max  speedup")
+    for factor in args.factors:
+        values = numpy.array([entry[factor] for entry in measured])
+        deviations = numpy.abs(values[:, 0] - full[:, 0])
+        factors[str(factor)] = {'mean': float(deviations.mean()), 'p95': float(numpy.percentile(deviations, 95)),
+                                'max': int(deviations.max()),
+                                'speedup': float(full[:, 1].sum() / max(1e-9, values[:, 1].sum()))}
+        print("%6d %6.2f %6.2f %6d %7.1fx" % ((factor,) + tuple(factors[str(factor)].values())))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'files': len(measured), 'profile': o3core.PROFILE.values(),
+                   'factors': factors}, f, indent=1)
+        f.write("\n")
+    print(str(len(measured)) + " pictures, calibration saved in " + args.output, file=sys.stderr)
+    return 1 if len(measured) < len(files) else 0
+
+## Entry point of the profiles subcommand: lists the measurement profiles.
+# @param argv command line arguments
+# @returns exit status
+def profilesMain(argv):
+    parser = argparse.ArgumentParser(prog="O3METER.py profiles",
+                                     description="List the measurement profiles found in " + Profile.directory() + ".")
+    parser.parse_args(argv)
+
+    status = 0
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['name'] + Profile.FIELDS + ['description'])
+    for name in Profile.names():
+        try:
+            profile = Profile.load(name)
+        except ValueError as e:
+            print(str(e), file=sys.stderr)
+            status = 1
+            continue
+        writer.writerow([profile.name] + profile.values() + [profile.description])
+    return status
+
+## Parses a date or date and time given in ISO 8601 format (local time).
+# @returns timestamp
+def parseTime(text):
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date: " + text)
+
+## Entry point of the query subcommand: prints the stored measurements.
+# @param argv command line arguments
+# @returns exit status
+def queryMain(argv):
+    parser = argparse.ArgumentParser(prog="O3METER.py query",
+                                     description="Print the stored measurements.")
+    parser.add_argument("--store", metavar="FILE", default=MeasurementStore.defaultPath(),
+                        help="measurement store (default: %(default)s)")
+    parser.add_argument("--station", help="only measurements of this station")
+    parser.add_argument("--since", type=parseTime, metavar="DATE", help="from this date (YYYY-MM-DD[THH:MM])")
+    parser.add_argument("--until", type=parseTime, metavar="DATE", help="before this date (YYYY-MM-DD[THH:MM])")
+    parser.add_argument("-o", "--output", help="output file (default: standard output)")
+    parser.add_argument("-f", "--format", choices=['csv', 'json'], default='csv', help="output format")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.store):
+        print("No measurements in " + args.store, file=sys.stderr)
+        return 1
+    store = MeasurementStore(args.store)
+    rows = store.query(args.station, args.since, args.until)
+    store.close()
+    for row in rows:
+        row['time'] = datetime.datetime.fromtimestamp(row['time']).isoformat(timespec='seconds')
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            json.dump(rows, out, indent=1)
+            out.write("\n")
+        else:
+            writer = csv.DictWriter(out, fieldnames=MeasurementStore.COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+################################################################################
+#
+# Reports of the measurements over time (see SeriesAggregator).
+#
+# By default, one row per station and day with measurements: their number,
+# mean, standard deviation, lowest and highest values and outliers, and the
+# number, mean and standard deviation of the trailing --window days. With
+# --trends, one row per station with the trend of its values, in Ozone Scale
+# units per day. With --outliers, the measurements flagged as outliers. The
+# estimates of the fast mode are only counted with --estimates.
+#
+#   O3METER.py report [--station NAME] [--since DATE] [--until DATE] [--trends | --outliers] [--estimates]
+#
+DAILY_FIELDS = ['station', 'date', 'count', 'mean', 'std', 'min', 'max', 'outliers', 'window_count',
+                'window_mean', 'window_std']
+TREND_FIELDS = ['station', 'first', 'last', 'days', 'count', 'mean', 'trend', 'outliers']
+OUTLIER_FIELDS = ['time', 'station', 'file', 'scale', 'baseline', 'spread']
+
+## Converts a value of an aggregate for the output: whole numbers are written
+# without decimals, the others are rounded and NaN becomes an empty value.
+def reportValue(value, digits=2):
+    value = value.item() if isinstance(value, numpy.generic) else value
+    if isinstance(value, float):
+        if value != value :
+            return ''
+        return int(value) if value.is_integer() else round(value, digits)
+    return value
+
+## Entry point of the report subcommand: prints the statistics of the stored
+# measurements over time.
+# @param argv command line arguments
+# @returns exit status
+def reportMain(argv):
+    parser = argparse.ArgumentParser(prog="O3METER.py report",
+                                     description="Print daily statistics, trends and outliers of the stored measurements.")
+    parser.add_argument("--store", metavar="FILE", default=MeasurementStore.defaultPath(),
+                        help="measurement store (default: %(default)s)")
+    parser.add_argument("--station", help="only measurements of this station")
+    parser.add_argument("--since", type=parseTime, metavar="DATE", help="from this date (YYYY-MM-DD[THH:MM])")
+    parser.add_argument("--until", type=parseTime, metavar="DATE", help="before this date (YYYY-MM-DD[THH:MM])")
+    parser.add_argument("--window", type=int, metavar="DAYS", default=SeriesAggregator.WINDOW,
+                        help="days of the trailing window (default: %(default)s)")
+    parser.add_argument("--sigmas", type=float, default=SeriesAggregator.SIGMAS,
+                        help="standard deviations from the mean of the window to flag an outlier (default: %(default)s)")
+    kind = parser.add_mutually_exclusive_group()
+    kind.add_argument("--trends", action='store_true', help="one row per station with the trend of its values")
+    kind.add_argument("--outliers", action='store_true', help="list the measurements flagged as outliers")
+    parser.add_argument("--estimates", action='store_true', help="also count the estimates of the fast mode")
+    parser.add_argument("-o", "--output", help="output file (default: standard output)")
+    parser.add_argument("-f", "--format", choices=['csv', 'json'], default='csv', help="output format")
+    args = parser.parse_args(argv)
+    if args.window < 1 :
+        parser.error("--window must be at least 1")
+
+    if not os.path.exists(args.store):
+        print("No measurements in " + args.store, file=sys.stderr)
+        return 1
+    store = MeasurementStore(args.store)
+    series = SeriesAggregator(args.window, args.sigmas)
+    rows = series.update(store, args.station, args.since, args.until, files=args.outliers,
+                         estimates=args.estimates)
+    store.close()
+
+    if args.outliers :
+        fields = OUTLIER_FIELDS
+        results = [{'time': datetime.datetime.fromtimestamp(rows['time'][i]).isoformat(timespec='seconds'),
+                    'station': rows['station'][i], 'file': rows['file'][i], 'scale': int(rows['scale'][i]),
+                    'baseline': reportValue(rows['baseline'][i]), 'spread': reportValue(rows['spread'][i])}
+                   for i in numpy.flatnonzero(rows['outlier'])]
+    elif args.trends :
+        fields = TREND_FIELDS
+        trends = series.trends()
+        results = []
+        for station, name in enumerate(series.stations):
+            result = {field: reportValue(trends[field][station], 4) for field in TREND_FIELDS[3:]}
+            result.update(station=name, first=SeriesAggregator.dayDate(trends['first'][station]).isoformat(),
+                          last=SeriesAggregator.dayDate(trends['last'][station]).isoformat())
+            results.append(result)
+    else:
+        fields = DAILY_FIELDS
+        statistics = series.statistics()
+        results = []
+        for station, day in zip(*numpy.nonzero(statistics['count'])):
+            result = {field: reportValue(statistics[field][station, day]) for field in DAILY_FIELDS[2:]}
+            result.update(station=series.stations[station],
+                          date=SeriesAggregator.dayDate(series.firstDay + day).isoformat())
+            results.append(result)
+        results.sort(key=lambda result: (result['station'], result['date']))
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        writeResults(results, out, args.format, fields)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+################################################################################
+#
+# Watch folder: measures the pictures dropped into a directory tree as they
+# arrive, for unattended stations.
+#
+# New files are noticed with inotify on Linux, or by scanning the tree every
+# few seconds elsewhere and on network shares (--poll). A file is only
+# measured once its size and modification time have not changed for --settle
+# seconds, so pictures still being copied are left alone. Measurements run in
+# a pool of worker processes, like batch runs, and are saved in the store and
+# printed as CSV. At most --queue files are handed to the pool at once; the
+# rest wait as mere names, so a burst of uploads never piles up decoded
+# pictures in memory.
+#
+#   O3METER.py watch DIR [DIR ...] [--jobs N] [--settle S] [--poll [S]] [--queue N] [--existing]
+#
+
+## Watches directory trees scanning them periodically.
+class PollingWatcher():
+
+    ## @param paths list of directories to watch
+    # @param interval seconds between scans
+    def __init__(self, paths, interval=5.0):
+        self.paths = paths
+        self.interval = interval
+        self.last = 0
+        self.seen = {}
+
+    ## Lists all the files of the watched trees.
+    def scan(self):
+        files = {}
+        for fileName in findImages(self.paths):
+            try:
+                st = os.stat(fileName)
+            except OSError:
+                continue
+            files[fileName] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    ## Waits for changes.
+    # @param timeout maximum time to wait in seconds
+    # @returns list of the files that were created or modified
+    def changes(self, timeout):
+        wait = self.last + self.interval - time.monotonic()
+        if wait > timeout :
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, wait))
+        self.last = time.monotonic()
+        files = self.scan()
+        changed = [fileName for fileName, signature in files.items() if self.seen.get(fileName) != signature]
+        self.seen = files
+        return changed
+
+    def close(self):
+        pass
+
+## Watches directory trees with the Linux inotify interface. Every
+# subdirectory is watched on its own, and new subdirectories are added (and
+# scanned, as files may have been written before the watch was set) when
+# they appear.
+class InotifyWatcher():
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')
+
+    ## @param paths list of directories to watch
+    # @throws OSError if inotify is not available
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1') :
+            raise OSError("inotify is not available")
+        self.libc = libc
+        self.paths = paths
+        self.fd = libc.inotify_init1(InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+        if self.fd < 0 :
+            raise OSError(ctypes.get_errno(), "inotify_init1: " + os.strerror(ctypes.get_errno()))
+        self.dirs = {}
+        for path in paths:
+            self.addTree(path)
+
+    ## Watches a directory and its subdirectories.
+    # @returns list of the files already present
+    def addTree(self, path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), InotifyWatcher.MASK)
+            if wd < 0 :
+                print("Cannot watch " + root + ": " + os.strerror(ctypes.get_errno()), file=sys.stderr)
+                continue
+            self.dirs[wd] = root
+            files.extend(os.path.join(root, name) for name in names)
+        return files
+
+    ## Waits for changes.
+    # @param timeout maximum time to wait in seconds
+    # @returns list of the files that were created or modified
+    def changes(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0] :
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        offset = 0
+        while offset + InotifyWatcher.EVENT.size <= len(data):
+            wd, mask, cookie, length = InotifyWatcher.EVENT.unpack_from(data, offset)
+            offset += InotifyWatcher.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & InotifyWatcher.IN_Q_OVERFLOW :
+                # Events were lost, everything has to be checked
+                changed.extend(findImages(self.paths))
+            elif wd in self.dirs :
+                path = os.path.join(self.dirs[wd], name)
+                if mask & InotifyWatcher.IN_ISDIR :
+                    changed.extend(self.addTree(path))
+                else:
+                    changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+## Entry point of the watch subcommand.
+# @param argv command line arguments
+# @returns exit status
+def watchMain(argv):
+    parser = argparse.ArgumentParser(prog="O3METER.py watch",
+                                     description="Measure the pictures copied into some directories as they arrive.")
+    parser.add_argument("paths", nargs='+', metavar="DIR", help="directories to watch")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--settle", type=float, default=2.0, metavar="S",
+                        help="seconds a file must stay unchanged before it is measured (default: %(default)s)")
+    parser.add_argument("--poll", type=float, nargs='?', const=5.0, metavar="S",
+                        help="scan the directories every S seconds (default: 5) instead of using inotify, "
+                             "needed on network shares")
+    parser.add_argument("--queue", type=int, metavar="N",
+                        help="maximum number of files being measured at once (default: 4 per job)")
+    parser.add_argument("--existing", action='store_true', help="also measure the pictures already present")
+    parser.add_argument("--cache", metavar="FILE", default=ResultCache.defaultPath(),
+                        help="results cache (default: %(default)s)")
+    parser.add_argument("--no-cache", dest='cache', action='store_const', const=None,
+                        help="do not use the results cache")
+    parser.add_argument("--store", metavar="FILE", default=MeasurementStore.defaultPath(),
+                        help="measurement store (default: %(default)s)")
+    parser.add_argument("--station", help="station recorded in the store (default: $O3METER_STATION or the host name)")
+    addProfileArgument(parser)
+    addFastArguments(parser)
+    parser.add_argument("--stats", metavar="FILE",
+                        help="write timings and counters of the processing as JSON when stopped ('-' for standard error)")
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+
+    for path in args.paths:
+        if not os.path.isdir(path):
+            print("Not a directory: " + path, file=sys.stderr)
+            return 1
+    maxQueue = args.queue or 4 * max(1, args.jobs)
+    worker = batchWorker if args.fast == None else fastOptions(args)
+
+    watcher = None
+    if args.poll == None :
+        try:
+            watcher = InotifyWatcher(args.paths)
+        except (OSError, AttributeError) as e:
+            print("Polling the directories: " + str(e), file=sys.stderr)
+    if watcher == None :
+        watcher = PollingWatcher(args.paths, args.poll or 5.0)
+
+    cache = None
+    if args.cache :
+        try:
+            cache = ResultCache(args.cache)
+        except (OSError, sqlite3.Error) as e:
+            print("Cache disabled: " + str(e), file=sys.stderr)
+            args.cache = None
+    store = MeasurementStore(args.store, args.station)
+
+    fields = BATCH_FIELDS if args.fast == None else FAST_FIELDS
+    writer = csv.DictWriter(sys.stdout, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+    sys.stdout.flush()
+
+    # Files waiting to settle: signature (size, modification time) and time
+    # it was last seen changing
+    pending = {}
+    # Settled files waiting for a worker
+    ready = collections.deque()
+    # Signature of every file measured or queued
+    done = {}
+    running = {}
+
+    if args.existing :
+        pending.update(dict.fromkeys(findImages(args.paths)))
+    else:
+        for fileName in findImages(args.paths):
+            try:
+                st = os.stat(fileName)
+                done[fileName] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                pass
+    if isinstance(watcher, PollingWatcher) :
+        watcher.seen = watcher.scan()
+
+    # Records the result of a file, or its failure.
+    # @returns True if the worker process measuring it died
+    def record(future, fileName):
+        try:
+            (result, key), stats = future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            result = dict.fromkeys(fields, '')
+            result.update(file=fileName, error="a worker process died while it was measured")
+            STATS.count('workers died')
+        except Exception as e:
+            result = dict.fromkeys(fields, '')
+            result.update(file=fileName, error=str(e) or type(e).__name__)
+        else:
+            STATS.merge(stats)
+        if result['error']:
+            print(result['file'] + ": " + result['error'], file=sys.stderr)
+        else:
+            touched = []
+            storeResult(cache, result, key, touched)
+            if touched :
+                cache.touch(touched)
+            store.add(result['file'], result)
+            store.flush()
+        writer.writerow(result)
+        sys.stdout.flush()
+        return result['error'].startswith("a worker process died")
+
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def newPool():
+        return concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=workerContext(),
+                                                      initializer=initWatchWorker,
+                                                      initargs=(args.cache, None, args.profile))
+
+    # A worker process died, e.g. crashing on a damaged RAW file: every file
+    # being measured fails with it and is reported, and a new pool measures
+    # the next ones, so the watch goes on
+    def replacePool(pool):
+        for future in concurrent.futures.as_completed(list(running)):
+            record(future, running.pop(future))
+        pool.shutdown(wait=False)
+        print("Worker process died, starting new workers", file=sys.stderr)
+        return newPool()
+
+    pool = newPool()
+    try:
+        while not stopping:
+            for fileName in watcher.changes(0.5 if pending or running else 5.0):
+                if fileName.lower().endswith(IMAGE_EXTENSIONS):
+                    pending.setdefault(fileName, None)
+
+            now = time.monotonic()
+            for fileName, state in list(pending.items()):
+                try:
+                    st = os.stat(fileName)
+                except OSError:
+                    del pending[fileName]
+                    continue
+                signature = (st.st_size, st.st_mtime_ns)
+                if done.get(fileName) == signature :
+                    del pending[fileName]
+                elif state == None or state[0] != signature :
+                    pending[fileName] = (signature, now)
+                elif now - state[1] >= args.settle and st.st_size > 0 :
+                    del pending[fileName]
+                    done[fileName] = signature
+                    ready.append(fileName)
+
+            broken = False
+            for future in [future for future in running if future.done()]:
+                broken = record(future, running.pop(future)) or broken
+            if broken :
+                pool = replacePool(pool)
+
+            while ready and len(running) < maxQueue:
+                fileName = ready.popleft()
+                try:
+                    running[pool.submit(withStats, worker, fileName)] = fileName
+                except concurrent.futures.process.BrokenProcessPool:
+                    ready.appendleft(fileName)
+                    pool = replacePool(pool)
+
+        # The files already being measured are recorded, the others can be
+        # measured later with --existing
+        for future in running:
+            future.cancel()
+        for future in concurrent.futures.as_completed(running):
+            if not future.cancelled():
+                record(future, running[future])
+    finally:
+        pool.shutdown(cancel_futures=True)
+        watcher.close()
+        store.close()
+        if cache != None :
+            cache.close()
+        if args.stats :
+            STATS.dump(args.stats, seconds=time.perf_counter() - start)
+
+    return 0
+
+COMMANDS = {'batch': batchMain, 'calibrate': calibrateMain, 'profiles': profilesMain, 'query': queryMain,
+            'report': reportMain, 'watch': watchMain}
@@ -0,0 +1,1596 @@
+# -*- coding: utf-8 -*-
+
+# O3METER
+# Copyright (C) 2018 Orlando Garcia-Feal - Universidade de Vigo - orlando@uvigo.es
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##
+# Core of O3METER: measurement of the pictures without the graphical interface.
+#
+# This module only needs numpy. Qt is imported when a picture has to be
+# decoded into a QImage, so the headless commands and the batch workers do
+# not load it unless they decode JPEG, PNG or TIFF files, and never need a
+# display.
+#
+
+import sys, os, shutil, time, socket, datetime, json, subprocess, hashlib, sqlite3, zlib
+import threading, contextlib, functools
+import numpy
+try:
+    import rawpy
+except ImportError:
+    rawpy = None
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+################################################################################
+#
+# Instrumentation of the processing.
+#
+# Timers add up the wall time spent in every stage (reading files, dcraw,
+# decoding, format conversion, the kernels, the cache and the store), with
+# the number of runs and the longest one. Counters record events such as the
+# pixels processed, cache hits or the times the brightness cutoff had to be
+# raised. All the code reports to the global STATS object, which the viewer
+# shows in its statistics panel and the headless commands dump as JSON
+# (--stats). It is shared by the threads of the viewer; every batch worker
+# process gathers its own and sends it back with the results (see withStats).
+# Stages can be nested: e.g. dcraw includes reading its output (ppm), which
+# includes the histogram.
+#
+class Stats():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    ## Clears all the timers and counters.
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+
+    ## Times a block of code.
+    #
+    #   with STATS.timer('decode'):
+    #       ...
+    #
+    # @param name name of the stage
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start)
+
+    ## Decorator timing every call of a function.
+    #
+    #   @STATS.timed('decode')
+    #   def decodeImage(fileName):
+    #
+    # @param name name of the stage
+    def timed(self, name):
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    ## Adds a run of a stage.
+    # @param name name of the stage
+    # @param seconds wall time of the run
+    def addTime(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    ## Increments a counter.
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    ## @returns dictionary with 'timers' (name: dictionary with 'runs',
+    # 'seconds' and 'max') and 'counters' (name: value)
+    def snapshot(self):
+        with self.lock:
+            return {'timers': {name: {'runs': runs, 'seconds': seconds, 'max': longest}
+                               for name, (runs, seconds, longest) in sorted(self.timers.items())},
+                    'counters': dict(sorted(self.counters.items()))}
+
+    ## Returns the snapshot and resets the statistics, for the batch workers.
+    def take(self):
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    ## Adds a snapshot, e.g. from a batch worker.
+    def merge(self, snapshot):
+        for name, timer in snapshot['timers'].items():
+            with self.lock:
+                current = self.timers.setdefault(name, [0, 0.0, 0.0])
+                current[0] += timer['runs']
+                current[1] += timer['seconds']
+                current[2] = max(current[2], timer['max'])
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+
+    ## Formats the statistics as a text table.
+    def report(self):
+        snapshot = self.snapshot()
+        lines = ["%-12s %6s %10s %10s" % ("stage", "runs", "total s", "max s")]
+        for name, timer in snapshot['timers'].items():
+            lines.append("%-12s %6d %10.3f %10.3f" % (name, timer['runs'], timer['seconds'], timer['max']))
+        lines.append("")
+        for name, value in snapshot['counters'].items():
+            lines.append("%-24s %12d" % (name, value))
+        return "\n".join(lines)
+
+    ## Writes the statistics as JSON.
+    # @param fileName output file, '-' for the standard error
+    # @param extra more entries for the dump (e.g. total wall time)
+    def dump(self, fileName, **extra):
+        snapshot = self.snapshot()
+        snapshot.update(extra)
+        if fileName == '-' :
+            json.dump(snapshot, sys.stderr, indent=1)
+            sys.stderr.write("\n")
+            return
+        with open(fileName, 'w') as f:
+            json.dump(snapshot, f, indent=1)
+            f.write("\n")
+
+STATS = Stats()
+
+################################################################################
+#
+# This class defines methods to make HUE <=> OZONE SCALE conversion.
+#
+# Hue values in a HSV representation can vary from 0 to 359. In our Ozone Scale
+# the hue of the samples can move from the yellow (no ozone at all) to blue
+# (max amount of ozone measurable). Hence our scale overlaps the HSV hue
+# values, so we should map HSV hue values to our Ozone Scale value. This is
+# values from 60 to 0 followed by values from 359 to 240 will be mapped to
+# range values [0, 180].
+#
+# Hue: 0-359
+# Scale: [60..0] & [359..240] ==> [0..180]
+#
+# The RGB to hue conversion reproduces QColor.hue() exactly (checked for all
+# the 256^3 colors) with integer numpy operations, so it works on whole arrays
+# and does not need Qt. Gray colors have no hue: -1, like in Qt.
+#
+# The 60 and 359 of the mapping are its default offset and wrap: a Profile can
+# change them to calibrate the scale.
+#
+class HueScale():
+    OFFSET = 60
+    WRAP = 359
+
+    ## Given a HSV hue value will return an Ozone Scale value.
+    def hueToScale(hue, offset=OFFSET, wrap=WRAP):
+        if hue <= offset :
+            return abs(hue - offset)
+        return abs(hue - wrap) + offset + 1
+
+    ## The inverse function is itself
+    def scaleToHue(scale, offset=OFFSET, wrap=WRAP):
+        return HueScale.hueToScale(scale, offset, wrap)
+
+    ## Vectorised version of hueToScale.
+    # @param hue numpy array of hue values
+    # @returns numpy array of Ozone Scale values
+    def huesToScales(hue, offset=OFFSET, wrap=WRAP):
+        hue = numpy.asarray(hue)
+        return numpy.where(hue <= offset, numpy.abs(hue - offset), numpy.abs(hue - wrap) + offset + 1)
+
+    ## Computes the HSV hue of RGB colors like QColor.hue() does.
+    #
+    # Qt computes the hue in floating point from the channels scaled to
+    # [0, 1], rounds hue * 100 to the nearest integer and truncates it to
+    # degrees. Here the same value is obtained from integers: t is 6000 times
+    # the hue (in degrees) times delta, so that the rounding is
+    # (2 t + delta) // (2 delta), and no ties can change the final degree.
+    # @param red, green, blue numpy arrays (or scalars) with 8 bit components
+    # @returns numpy array of hues (0-359, -1 for grays)
+    def rgbToHue(red, green, blue):
+        r = numpy.asarray(red, dtype=numpy.int32)
+        g = numpy.asarray(green, dtype=numpy.int32)
+        b = numpy.asarray(blue, dtype=numpy.int32)
+
+        vmax = numpy.maximum(numpy.maximum(r, g), b)
+        delta = vmax - numpy.minimum(numpy.minimum(r, g), b)
+
+        t = numpy.where(r == vmax, 6000 * (g - b) + numpy.where(g < b, 36000 * delta, 0),
+            numpy.where(g == vmax, 12000 * delta + 6000 * (b - r),
+                        24000 * delta + 6000 * (r - g)))
+        d = numpy.maximum(delta, 1)
+        return numpy.where(delta == 0, -1, ((2 * t + d) // (2 * d)) // 100)
+
+    ## Given the components of a RGB color will return an Ozone Scale value.
+    # The components can also be numpy arrays, then an array is returned.
+    def rgbToScale(red, green, blue, offset=OFFSET, wrap=WRAP):
+        scale = HueScale.huesToScales(HueScale.rgbToHue(red, green, blue), offset, wrap)
+        return int(scale) if scale.ndim == 0 else scale
+
+    ## Computes the Ozone Scale value of every pixel of an image.
+    # @param arr numpy array with the image data (BGR)
+    # @returns numpy array (int16) of shape (height, width)
+    def scaleMap(arr, offset=OFFSET, wrap=WRAP):
+        out = numpy.empty(arr.shape[:2], dtype=numpy.int16)
+        rows = max(1, ChannelHistogram.BLOCK_PIXELS // max(1, arr.shape[1]))
+        for y in range(0, arr.shape[0], rows):
+            block = arr[y:y + rows]
+            out[y:y + rows] = HueScale.rgbToScale(block[:, :, 2], block[:, :, 1], block[:, :, 0], offset, wrap)
+        return out
+
+################################################################################
+#
+# Histogram of the brightest channel of every pixel. For each possible value
+# of max(red, green, blue) it keeps the number of pixels and the sum of each
+# channel, so the mean color of the pixels below any brightness cutoff can be
+# obtained from it without going back to the image.
+#
+# The image is consumed in blocks of rows, hence the temporary arrays are
+# bounded by BLOCK_PIXELS no matter how large the picture is. Inside a block
+# everything stays in 8 and 16 bit integers: the brightest channel and each
+# channel value are packed into a 16 bit index and a joint 256x256 histogram is
+# counted, from which the per-bin sums are obtained.
+#
+# Note: the pixel count only includes pixels with a non-zero red channel, while
+# the sums include all of them. This is how the mean has always been computed
+# (the count came from numpy.count_nonzero over the red values) and it is kept
+# so that readings do not change.
+#
+DARK_THRESHOLD = 150
+BRIGHT_THRESHOLD = 250
+MIN_DARK_PIXELS = 100
+
+class ChannelHistogram():
+    BLOCK_PIXELS = 1 << 18
+    LEVELS = numpy.arange(256, dtype=numpy.int64)
+
+    def __init__(self):
+        self.counts = numpy.zeros(256, dtype=numpy.int64)
+        self.sums = numpy.zeros((3, 256), dtype=numpy.int64)
+
+    ## Builds the histogram of an image array.
+    # @param arr numpy array with the image data (BGR)
+    # @param progress optional function called with the processed and total rows
+    def fromArray(arr, progress=None):
+        hist = ChannelHistogram()
+        rows = max(1, ChannelHistogram.BLOCK_PIXELS // max(1, arr.shape[1]))
+        for y in range(0, arr.shape[0], rows):
+            block = arr[y:y + rows]
+            hist.add(block[:, :, 2], block[:, :, 1], block[:, :, 0])
+            if progress != None :
+                progress(min(y + rows, arr.shape[0]), arr.shape[0])
+        return hist
+
+    ## Accumulates a block of pixels given as three uint8 channel arrays.
+    @STATS.timed('histogram')
+    def add(self, red, green, blue):
+        STATS.count('pixels', red.size)
+        values = numpy.maximum(red, green)
+        numpy.maximum(values, blue, out=values)
+        index = values.astype(numpy.uint16)
+        index <<= 8
+
+        for i, channel in enumerate((red, green, blue)):
+            joint = numpy.bincount((index | channel).reshape(-1), minlength=65536).reshape(256, 256)
+            self.sums[i] += joint @ ChannelHistogram.LEVELS
+            if i == 0 :
+                self.counts += joint[:, 1:].sum(axis=1)
+
+    ## Mean color of the pixels whose brightest channel is below the threshold.
+    # @returns tuple with the red, green and blue means and the number of pixels
+    def mean(self, threshold):
+        nvals = int(self.counts[:threshold].sum())
+        if nvals == 0 :
+            raise ValueError("no pixels darker than " + str(threshold))
+        rSum, gSum, bSum = (int(v) for v in self.sums[:, :threshold].sum(axis=1))
+        return int(rSum / nvals), int(gSum / nvals), int(bSum / nvals), nvals
+
+    ## Mean color of the darker pixels, raising the cutoff for too bright
+    # pictures.
+    # @param weight number of pixels of the picture every pixel of the
+    # histogram stands for, when it was built from a reduced picture
+    # @param profile Profile with the thresholds (default: the current one)
+    def darkMean(self, weight=1, profile=None):
+        profile = profile or PROFILE
+        STATS.count('measurements')
+        if int(self.counts[:profile.darkThreshold].sum()) * weight < profile.minDarkPixels :
+            STATS.count('bright fallbacks')
+            rMean, gMean, bMean, nvals = self.mean(profile.brightThreshold)
+        else:
+            rMean, gMean, bMean, nvals = self.mean(profile.darkThreshold)
+        return rMean, gMean, bMean, int(round(nvals * weight))
+
+    ## Serializes the histogram.
+    # @returns bytes
+    def toBytes(self):
+        return zlib.compress(self.counts.tobytes() + self.sums.tobytes(), 1)
+
+    ## Builds a histogram serialized by toBytes.
+    def fromBytes(data):
+        values = numpy.frombuffer(zlib.decompress(data), dtype=numpy.int64)
+        hist = ChannelHistogram()
+        hist.counts[:] = values[:256]
+        hist.sums[:] = values[256:].reshape(3, 256)
+        return hist
+
+## Computes the mean color of the darker pixels of an image. Only the pixels
+# whose brightest channel is below 150 are taken into account, so the
+# background of the photograph is discarded. If the picture is too bright and
+# less than 100 pixels pass this filter, the cutoff is raised to 250.
+#
+# This function does not depend on any widget, so it can be used from the GUI
+# threads as well as from the headless batch workers.
+#
+# @param arr numpy array with the image data (BGR)
+# @returns tuple with the red, green and blue means and the number of pixels
+def darkPixelsMean(arr):
+    return ChannelHistogram.fromArray(arr).darkMean()
+
+################################################################################
+#
+# Measurement profiles: the brightness thresholds and the hue mapping used to
+# measure, calibrated per camera or per batch of strips.
+#
+# Profiles are JSON or TOML files named after the profile in the profiles
+# directory, with any of the keys in FIELDS; missing keys keep the default
+# values, e.g.
+#
+#   {"description": "Station 2 camera", "dark_threshold": 140, "hue_offset": 58}
+#
+# The current profile is the global PROFILE, see setProfile.
+#
+class Profile():
+    FIELDS = ['dark_threshold', 'bright_threshold', 'min_dark_pixels', 'hue_offset', 'hue_wrap']
+
+    def __init__(self, name='default', description='', dark_threshold=DARK_THRESHOLD,
+                 bright_threshold=BRIGHT_THRESHOLD, min_dark_pixels=MIN_DARK_PIXELS,
+                 hue_offset=HueScale.OFFSET, hue_wrap=HueScale.WRAP):
+        self.name = name
+        self.description = description
+        self.darkThreshold = int(dark_threshold)
+        self.brightThreshold = int(bright_threshold)
+        self.minDarkPixels = int(min_dark_pixels)
+        self.hueOffset = int(hue_offset)
+        self.hueWrap = int(hue_wrap)
+        if not 0 < self.darkThreshold <= self.brightThreshold <= 256 :
+            raise ValueError("the thresholds must be 0 < dark <= bright <= 256")
+        if not 0 <= self.hueOffset < self.hueWrap < 360 :
+            raise ValueError("the hue mapping must be 0 <= offset < wrap < 360")
+
+    ## Default location of the profiles.
+    def directory():
+        base = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+        return os.path.join(base, 'o3meter', 'profiles')
+
+    ## Name of the profile used when none is chosen: $O3METER_PROFILE or
+    # 'default'.
+    def defaultName():
+        return os.environ.get('O3METER_PROFILE') or 'default'
+
+    ## Names of the available profiles, 'default' first.
+    def names():
+        try:
+            files = os.listdir(Profile.directory())
+        except OSError:
+            files = []
+        names = {os.path.splitext(f)[0] for f in files if f.endswith(('.json', '.toml'))}
+        return ['default'] + sorted(names - {'default'})
+
+    ## Loads a profile.
+    # @param name name of a profile in the profiles directory, or file name
+    # @returns Profile
+    # @throws ValueError if the profile does not exist or is not valid
+    def load(name):
+        path = name
+        if not os.path.isfile(path):
+            if name == 'default' :
+                return Profile()
+            for ext in ('.json', '.toml'):
+                path = os.path.join(Profile.directory(), name + ext)
+                if os.path.isfile(path):
+                    break
+            else:
+                raise ValueError("no profile named " + name)
+
+        try:
+            if path.endswith('.toml'):
+                if tomllib == None :
+                    raise ValueError("TOML profiles need Python 3.11 or tomli")
+                with open(path, 'rb') as f:
+                    values = tomllib.load(f)
+            else:
+                with open(path) as f:
+                    values = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError(path + ": " + str(e))
+        if not isinstance(values, dict):
+            raise ValueError(path + ": not a profile")
+        unknown = set(values) - set(Profile.FIELDS) - {'description'}
+        if unknown :
+            raise ValueError(path + ": unknown keys " + ", ".join(sorted(unknown)))
+        try:
+            return Profile(os.path.splitext(os.path.basename(path))[0], **values)
+        except (TypeError, ValueError) as e:
+            raise ValueError(path + ": " + str(e))
+
+    ## Values of the profile, in the order of FIELDS. Two profiles with the
+    # same values measure the same.
+    def values(self):
+        return [self.darkThreshold, self.brightThreshold, self.minDarkPixels, self.hueOffset, self.hueWrap]
+
+    ## Ozone Scale value of a color (or arrays of colors), see HueScale.
+    def scale(self, red, green, blue):
+        return HueScale.rgbToScale(red, green, blue, self.hueOffset, self.hueWrap)
+
+    ## Hue shown for an Ozone Scale value.
+    def hue(self, scale):
+        return HueScale.scaleToHue(scale, self.hueOffset, self.hueWrap)
+
+    ## Measures a picture from its histogram.
+    # @param hist ChannelHistogram of the picture
+    # @param weight see ChannelHistogram.darkMean
+    # @returns dictionary with the Ozone Scale value ('scale'), the mean color
+    # and the number of pixels
+    # @throws ValueError if no pixel is dark enough
+    def measure(self, hist, weight=1):
+        rMean, gMean, bMean, nvals = hist.darkMean(weight, self)
+        return {'scale': self.scale(rMean, gMean, bMean), 'red': rMean, 'green': gMean,
+                'blue': bMean, 'pixels': nvals}
+
+PROFILE = Profile()
+
+## Changes the current profile.
+def setProfile(profile):
+    global PROFILE
+    PROFILE = profile
+
+################################################################################
+#
+# Summed-area tables (integral images) of the red, green and blue channels.
+# Once built, the sum of any rectangle is obtained from four values of the
+# table plus, at most, ROW_STEP - 1 rows above and below it that are summed
+# directly from the image, so the mean color of a selection is obtained
+# almost instantly regardless of its size.
+#
+# Only one row of the table out of ROW_STEP is stored, which keeps the tables
+# well below the size of the image itself (12 / ROW_STEP bytes per pixel). They
+# are stored as uint32 and are allowed to wrap around: modular arithmetic still
+# gives the exact sum of every rectangle whose sum fits in 32 bits, which holds
+# for any rectangle up to MAX_AREA pixels. Larger rectangles are summed
+# directly from the image.
+#
+class IntegralImage():
+    MAX_AREA = (1 << 32) // 255
+    ROW_STEP = 16
+
+    ## @param arr numpy array with the image data (BGR)
+    @STATS.timed('integral')
+    def __init__(self, arr):
+        self.arr = arr
+        self.height, self.width = arr.shape[:2]
+        self.rows = numpy.append(numpy.arange(0, self.height, IntegralImage.ROW_STEP), self.height)
+        self.table = numpy.zeros((3, self.rows.size, self.width + 1), dtype=numpy.uint32)
+        for i, channel in enumerate((2, 1, 0)):
+            view = self.table[i, 1:, 1:]
+            if self.height > 0 :
+                numpy.add.reduceat(arr[:, :, channel], self.rows[:-1], axis=0, dtype=numpy.uint32, out=view)
+            numpy.cumsum(view, axis=0, dtype=numpy.uint32, out=view)
+            numpy.cumsum(view, axis=1, dtype=numpy.uint32, out=view)
+
+    ## Mean color of every tile of a grid laid over the whole image, computed
+    # for all the tiles at once. If the tile size is a multiple of ROW_STEP
+    # the sums are read from the table, otherwise the image is reduced by
+    # blocks.
+    # @param tile size of the tiles in pixels (the tiles of the last row and
+    # column may be smaller)
+    # @returns tuple with the red, green and blue means and the number of
+    # pixels of each tile, as arrays of shape (rows, columns)
+    @STATS.timed('tiles')
+    def tileMeans(self, tile):
+        ys = numpy.append(numpy.arange(0, self.height, tile), self.height)
+        xs = numpy.append(numpy.arange(0, self.width, tile), self.width)
+        counts = numpy.outer(numpy.diff(ys), numpy.diff(xs))
+
+        small = tile * tile <= IntegralImage.MAX_AREA
+        if small and tile % IntegralImage.ROW_STEP == 0 :
+            corners = self.table[:, numpy.searchsorted(self.rows, ys)][:, :, xs].astype(numpy.int64)
+            sums = numpy.diff(numpy.diff(corners, axis=1), axis=2) & 0xFFFFFFFF
+        else:
+            dtype = numpy.uint32 if small else numpy.uint64
+            sums = numpy.stack([numpy.add.reduceat(numpy.add.reduceat(self.arr[:, :, channel], xs[:-1], axis=1,
+                                                                      dtype=dtype), ys[:-1], axis=0)
+                                for channel in (2, 1, 0)])
+
+        means = sums // numpy.maximum(counts, 1)
+        return means[0], means[1], means[2], counts
+
+    ## Sums of each channel in a rectangle, directly from the image.
+    def direct(self, xo, yo, xd, yd):
+        region = self.arr[yo:yd, xo:xd]
+        return [int(region[:, :, channel].sum(dtype=numpy.uint64)) for channel in (2, 1, 0)]
+
+    ## Mean color of a rectangle of the image. The limits are clipped to the
+    # image like a numpy slice would be.
+    # @param xo,yo top left corner (inclusive)
+    # @param xd,yd bottom right corner (exclusive)
+    # @returns tuple with the red, green and blue means and the number of
+    # pixels, or None if the rectangle is empty
+    def mean(self, xo, yo, xd, yd):
+        xo, xd = max(0, min(xo, self.width)), max(0, min(xd, self.width))
+        yo, yd = max(0, min(yo, self.height)), max(0, min(yd, self.height))
+        area = (xd - xo) * (yd - yo)
+        if area <= 0 :
+            return None
+
+        # Rows of the table enclosed by the rectangle
+        ja = int(numpy.searchsorted(self.rows, yo, 'left'))
+        jb = int(numpy.searchsorted(self.rows, yd, 'right')) - 1
+
+        STATS.count('regions')
+        if ja >= jb or (xd - xo) * int(self.rows[jb] - self.rows[ja]) > IntegralImage.MAX_AREA :
+            STATS.count('regions summed directly')
+            sums = self.direct(xo, yo, xd, yd)
+        else:
+            corners = self.table[:, [jb, ja, jb, ja], [xd, xd, xo, xo]].astype(numpy.int64)
+            middle = [int(v) & 0xFFFFFFFF for v in corners @ numpy.array([1, -1, -1, 1])]
+            top = self.direct(xo, yo, xd, int(self.rows[ja]))
+            bottom = self.direct(xo, int(self.rows[jb]), xd, yd)
+            sums = [m + t + b for m, t, b in zip(middle, top, bottom)]
+
+        return int(sums[0] / area), int(sums[1] / area), int(sums[2] / area), area
+
+################################################################################
+#
+# Exposes the pixels of a QImage to numpy without copying them.
+#
+# The image is converted (only if needed) to a packed format and kept by this
+# object; numpy arrays built from it reference this object, so the buffer can
+# not be freed while any array is alive. The arrays are read-only views with
+# shape (height, width, 3) in BGR order whatever the format is, hence the
+# alpha channel is never touched.
+#
+# With dropAlpha the image is stored as RGB888, which needs 3 bytes per pixel
+# instead of 4. Otherwise RGB32 is used, which avoids any conversion when the
+# decoder already produced a 32 bit image.
+#
+# A writable view can be requested to fill an image that is already in the
+# right format; the image is then used as is, not converted.
+#
+class ImageBuffer():
+
+    ## @param image QImage with the picture
+    # @param dropAlpha store the pixels as RGB888 instead of RGB32
+    # @param writable return writable arrays
+    def __init__(self, image, dropAlpha=True, writable=False):
+        from PyQt5.QtGui import QImage
+        format = QImage.Format_RGB888 if dropAlpha else QImage.Format_RGB32
+        if dropAlpha :
+            offset, step, order = 2, 3, -1
+        else:
+            offset, step, order = 0, 4, 1
+
+        if writable :
+            if image.format() != format :
+                raise ValueError("the image must be in the buffer format to be written")
+            self.image = image
+            address = int(self.image.bits()) if not self.image.isNull() else 0
+        else:
+            if image.format() != format :
+                STATS.count('format conversions')
+            with STATS.timer('convert'):
+                self.image = image.convertToFormat(format)
+            address = int(self.image.constBits()) if not self.image.isNull() else 0
+        self.__array_interface__ = {
+            'version': 3,
+            'typestr': '|u1',
+            'shape': (self.image.height(), self.image.width(), 3),
+            'strides': (self.image.bytesPerLine(), step, order),
+            'data': (address + offset, not writable),
+        }
+
+    ## @returns numpy view of the pixels
+    def array(self):
+        return numpy.asarray(self)
+
+## Converts a QImage into a numpy array (BGR) to be processed later.
+# @param image QImage with the picture
+# @param dropAlpha see ImageBuffer
+# @returns numpy array of shape (height, width, 3) sharing the image buffer
+def imageToArray(image, dropAlpha=True):
+    return ImageBuffer(image, dropAlpha).array()
+
+################################################################################
+#
+# Reads the binary PPM (P6) stream written by dcraw block by block, as the rows
+# are produced, so a RAW file can be processed without waiting for dcraw to
+# finish nor keeping all its output in memory. 16 bit streams are scaled down
+# to 8 bits.
+#
+DCRAW_ARGS = ["-c", "-w", "-b", "2.0"]
+RAW_EXTENSIONS = ('.cr2', '.crw', '.nef', '.nrw', '.arw', '.srf', '.sr2', '.dng', '.orf', '.rw2',
+                  '.raf', '.pef', '.srw', '.rwl', '.3fr', '.erf', '.kdc', '.mrw', '.x3f')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.ppm') + RAW_EXTENSIONS
+
+class PPMStream():
+    BLOCK_PIXELS = 1 << 18
+
+    ## Reads the header of the stream.
+    # @param stream binary file object
+    def __init__(self, stream):
+        self.stream = stream
+        tokens = []
+        token = b''
+        while len(tokens) < 4:
+            c = stream.read(1)
+            if not c :
+                raise ValueError("truncated PPM header")
+            if c == b'#' and not token :
+                stream.readline()
+            elif c.isspace():
+                if token :
+                    tokens.append(token)
+                    token = b''
+            else:
+                token += c
+
+        if tokens[0] != b'P6' :
+            raise ValueError("not a PPM stream")
+        self.width, self.height, self.maxval = (int(t) for t in tokens[1:])
+
+    ## Iterates over the image in blocks of rows. The same buffer is reused for
+    # every block.
+    # @returns generator of tuples with the first row of the block and a
+    # numpy array of shape (rows, width, 3) in RGB order
+    def blocks(self):
+        dtype = numpy.dtype(numpy.uint8) if self.maxval < 256 else numpy.dtype('>u2')
+        rows = max(1, PPMStream.BLOCK_PIXELS // max(1, self.width))
+        buffer = numpy.empty((min(rows, self.height), self.width, 3), dtype=dtype)
+
+        for y in range(0, self.height, rows):
+            block = buffer[:min(rows, self.height - y)]
+            data = memoryview(block.reshape(-1).view(numpy.uint8))
+            done = 0
+            while done < len(data):
+                n = self.stream.readinto(data[done:])
+                if not n :
+                    raise ValueError("truncated PPM data")
+                done += n
+
+            if self.maxval != 255 :
+                # Scaled to 8 bits like QImage: widened to 16 bits truncating,
+                # then rounded
+                wide = block.astype(numpy.uint32) * 65535 // self.maxval
+                block = ((wide + 128) // 257).astype(numpy.uint8)
+            yield y, block
+
+## Reads a PPM stream. The histogram needed for the measurement is
+# accumulated on the fly; the picture itself is only stored if requested.
+# @param stream binary file object
+# @param keepImage store the picture in a QImage
+# @param progress optional function called with the decoded and total rows
+# @returns tuple with the QImage (or None) and the ChannelHistogram
+# @throws ValueError if the stream is not a valid PPM
+@STATS.timed('ppm')
+def readPPM(stream, keepImage=True, progress=None):
+    image = None
+    hist = ChannelHistogram()
+    ppm = PPMStream(stream)
+    if keepImage :
+        from PyQt5.QtGui import QImage
+        image = QImage(ppm.width, ppm.height, QImage.Format_RGB888)
+        arr = ImageBuffer(image, writable=True).array()
+    for y, block in ppm.blocks():
+        hist.add(block[:, :, 0], block[:, :, 1], block[:, :, 2])
+        if keepImage :
+            arr[y:y + block.shape[0]] = block[:, :, ::-1]
+        if progress != None :
+            progress(y + block.shape[0], ppm.height)
+    return image, hist
+
+## Decodes a RAW file with dcraw, processing its output while it is produced
+# (see readPPM).
+# @param fileName name of the RAW file
+# @param keepImage store the picture in a QImage
+# @param progress optional function called with the decoded and total rows
+# @param halfSize have dcraw output half the width and height (-h), which is
+# much faster
+# @returns tuple with the QImage (or None) and the ChannelHistogram
+@STATS.timed('dcraw')
+def streamRaw(fileName, keepImage=True, progress=None, halfSize=False):
+    dcpath = shutil.which("dcraw")
+    if dcpath == None :
+        raise RuntimeError("dcraw is not present in the system")
+
+    dcraw = subprocess.Popen([dcpath] + DCRAW_ARGS + (["-h"] if halfSize else []) + [fileName],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        image, hist = readPPM(dcraw.stdout, keepImage, progress)
+    except BaseException as e:
+        dcraw.kill()
+        message = dcraw.communicate()[1].decode(errors='replace').strip()
+        if isinstance(e, ValueError):
+            raise RuntimeError(message or str(e)) from None
+        raise
+    dcraw.communicate()
+
+    return image, hist
+
+################################################################################
+#
+# Decoding of RAW files in process with LibRaw (through the optional rawpy
+# module), which saves starting dcraw and piping its output for every file.
+# LibRaw is the library version of dcraw: LIBRAW_PARAMS are the equivalent of
+# DCRAW_ARGS, so both decoders give the same picture. Files LibRaw does not
+# support are still handed to dcraw.
+#
+LIBRAW_PARAMS = {'use_camera_wb': True, 'bright': 2.0, 'output_bps': 8}
+
+## Decoder used for the RAW files: 'libraw' if rawpy is installed, 'dcraw'
+# otherwise. Setting $O3METER_RAW_DECODER to 'dcraw' forces the use of dcraw.
+def rawDecoder():
+    if rawpy != None and os.environ.get('O3METER_RAW_DECODER') != 'dcraw' :
+        return 'libraw'
+    return 'dcraw'
+
+## Decodes a RAW file with LibRaw. The demosaiced picture is handed over as a
+# numpy array, and the histogram is accumulated from it block by block.
+# @param fileName name of the RAW file
+# @param keepImage store the picture in a QImage
+# @param progress optional function called with the processed and total rows
+# @param halfSize decode at half the width and height, which is much faster
+# @returns tuple with the QImage (or None) and the ChannelHistogram
+# @throws rawpy.LibRawError if LibRaw cannot decode the file
+@STATS.timed('libraw')
+def decodeLibRaw(fileName, keepImage=True, progress=None, halfSize=False):
+    with rawpy.imread(fileName) as raw:
+        rgb = raw.postprocess(half_size=halfSize, **LIBRAW_PARAMS)
+
+    image = None
+    hist = ChannelHistogram()
+    if keepImage :
+        from PyQt5.QtGui import QImage
+        image = QImage(rgb.shape[1], rgb.shape[0], QImage.Format_RGB888)
+        arr = ImageBuffer(image, writable=True).array()
+    rows = max(1, ChannelHistogram.BLOCK_PIXELS // max(1, rgb.shape[1]))
+    for y in range(0, rgb.shape[0], rows):
+        block = rgb[y:y + rows]
+        hist.add(block[:, :, 0], block[:, :, 1], block[:, :, 2])
+        if keepImage :
+            arr[y:y + block.shape[0]] = block[:, :, ::-1]
+        if progress != None :
+            progress(y + block.shape[0], rgb.shape[0])
+    return image, hist
+
+## Decodes a RAW file with the decoder given by rawDecoder, falling back to
+# dcraw for the files LibRaw cannot decode. The parameters and result are
+# those of streamRaw.
+def readRaw(fileName, keepImage=True, progress=None, halfSize=False):
+    if rawDecoder() == 'libraw' :
+        try:
+            return decodeLibRaw(fileName, keepImage, progress, halfSize)
+        except rawpy.LibRawError as e:
+            if shutil.which("dcraw") == None :
+                message = e.args[0] if e.args else b''
+                if isinstance(message, bytes):
+                    message = message.decode(errors='replace')
+                raise RuntimeError(str(message) or "cannot decode RAW data") from None
+            STATS.count('dcraw fallbacks')
+    return streamRaw(fileName, keepImage, progress, halfSize)
+
+## Reduces an image by an integer factor averaging blocks of factor x factor
+# pixels. The image is processed in blocks of rows to bound the temporaries.
+# The rows of every block are added first and then the columns, with strided
+# slices, which numpy runs much faster than a reduction over a reshaped view.
+# @param arr numpy array with the image data (BGR)
+# @param factor reduction factor
+# @returns numpy array (BGR, uint8) of shape (height // factor, width // factor, 3)
+@STATS.timed('downsample')
+def downsample(arr, factor):
+    height, width = arr.shape[0] // factor, arr.shape[1] // factor
+    out = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    dtype = numpy.uint16 if factor <= 16 else numpy.uint32
+    rows = max(1, ChannelHistogram.BLOCK_PIXELS // max(1, width * factor * factor))
+    for y in range(0, height, rows):
+        n = min(rows, height - y)
+        block = arr[y * factor:(y + n) * factor, :width * factor, :3]
+        sums = numpy.zeros((n, width * factor, 3), dtype=dtype)
+        for i in range(factor):
+            sums += block[i::factor]
+        columns = sums[:, ::factor].copy()
+        for j in range(1, factor):
+            columns += sums[:, j::factor]
+        out[y:y + n] = columns // (factor * factor)
+    return out
+
+## Builds a QImage (RGB888) with a copy of an image array.
+# @param arr numpy array with the image data (BGR)
+# @returns QImage
+def arrayToImage(arr):
+    from PyQt5.QtGui import QImage
+    image = QImage(arr.shape[1], arr.shape[0], QImage.Format_RGB888)
+    ImageBuffer(image, writable=True).array()[...] = arr[:, :, :3]
+    return image
+
+## Decodes a picture given a file name.
+# @param fileName name of the file
+# @returns QImage with the picture
+@STATS.timed('decode')
+def decodeImage(fileName):
+    if fileName.lower().endswith(RAW_EXTENSIONS):
+        image = readRaw(fileName)[0]
+    else:
+        from PyQt5.QtGui import QImageReader
+        reader = QImageReader(fileName)
+        reader.setAutoTransform(True)
+        image = reader.read()
+        if image.isNull():
+            raise RuntimeError(reader.errorString())
+    if image.isNull():
+        raise RuntimeError("cannot decode image")
+    return image
+
+################################################################################
+#
+# Automatic detection of the strips of a photograph.
+#
+# The picture is reduced to about DETECT_SIZE pixels and its dark pixels are
+# found with the same criterion used to measure the whole image. The strips
+# are the runs of columns (or rows, if the strips lie horizontally) where dark
+# pixels are frequent, and their extent along the other axis is the longest
+# run of rows (or columns) where dark pixels are frequent inside the strip.
+#
+DETECT_SIZE = 512
+STRIP_COVER = 0.3
+STRIP_MIN_SIZE = 0.01
+
+## Finds the runs of an array of booleans.
+# @param flags numpy array of booleans
+# @param minLength shortest run returned
+# @returns list of tuples (start, end) with end exclusive
+def findRuns(flags, minLength=1):
+    edges = numpy.diff(numpy.concatenate(([0], flags.astype(numpy.int8), [0])))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    return [(int(a), int(b)) for a, b in zip(starts, ends) if b - a >= minLength]
+
+## Finds the strips of a dark pixel mask lying along its first axis.
+# @param mask numpy array of booleans (rows, columns)
+# @returns list of tuples (column start, row start, column end, row end)
+def findStripsInMask(mask):
+    profile = mask.mean(axis=0)
+    if profile.size == 0 or profile.max() == 0 :
+        return []
+    minSize = max(2, int(STRIP_MIN_SIZE * mask.shape[1]))
+    strips = []
+    for xo, xd in findRuns(profile >= STRIP_COVER * profile.max(), minSize):
+        rows = mask[:, xo:xd].mean(axis=1)
+        runs = findRuns(rows >= STRIP_COVER * rows.max(), minSize)
+        if runs :
+            yo, yd = max(runs, key=lambda run: run[1] - run[0])
+            strips.append((xo, yo, xd, yd))
+    return strips
+
+## Finds the strips of an image.
+# @param arr numpy array with the image data (BGR)
+# @returns list of rectangles (x0, y0, x1, y1) in pixels of the image, with x1
+# and y1 exclusive, sorted from left to right or from top to bottom
+def findStrips(arr):
+    factor = max(1, -(-max(arr.shape[:2]) // DETECT_SIZE))
+    small = downsample(arr, factor) if factor > 1 else arr[:, :, :3]
+    values = small.max(axis=2)
+
+    mask = values < PROFILE.darkThreshold
+    if int(mask.sum()) * factor * factor < PROFILE.minDarkPixels :
+        mask = values < PROFILE.brightThreshold
+
+    # Strips side by side (vertical) or one above another (horizontal)
+    vertical = findStripsInMask(mask)
+    horizontal = [(xo, yo, xd, yd) for yo, xo, yd, xd in findStripsInMask(mask.T)]
+    strips = horizontal if len(horizontal) > len(vertical) else vertical
+
+    height, width = arr.shape[:2]
+    return [(xo * factor, yo * factor, min(width, xd * factor), min(height, yd * factor))
+            for xo, yo, xd, yd in strips]
+
+## Detects and measures all the strips of an image. Each strip is measured
+# like a whole picture, using only its darker pixels.
+# @param arr numpy array with the image data (BGR)
+# @returns list of dictionaries with the Ozone Scale value ('scale'), the
+# mean color, the number of pixels and the region of every strip
+@STATS.timed('strips')
+def measureStrips(arr):
+    results = []
+    for xo, yo, xd, yd in findStrips(arr):
+        try:
+            result = PROFILE.measure(ChannelHistogram.fromArray(arr[yo:yd, xo:xd]))
+        except ValueError:
+            continue
+        result.update({'region': (xo, yo, xd, yd), 'width': arr.shape[1], 'height': arr.shape[0],
+                       'thresholds': (PROFILE.darkThreshold, PROFILE.brightThreshold)})
+        results.append(result)
+    return results
+
+################################################################################
+#
+# On-disk cache of measurements, so reopening a picture or running a batch
+# again does not decode it.
+#
+# Entries are keyed by the digest of a file, the SHA-256 of its contents
+# together with the parameters it is decoded with (RAW decoder and
+# arguments), and the values of the profile, hence a renamed file is still
+# found and a change of parameters is never served a stale value. Each entry
+# holds the measurement and, optionally, a reduced preview of the picture (at
+# most PREVIEW_SIZE pixels on its long side) that the viewer shows instead of
+# decoding the file.
+#
+# The histogram of every picture is also kept, keyed by its digest only, so
+# a picture can be measured with another profile without decoding it. The
+# digests themselves are remembered by path, size and modification time, so
+# measuring a whole archive again does not even read the files, until the
+# histogram is evicted.
+#
+# The cache is a SQLite database in WAL mode, so several batch workers can
+# read it while another process writes. When its size goes over maxBytes the
+# least recently used entries are removed.
+#
+class ResultCache():
+    PREVIEW_SIZE = 2048
+    MAX_BYTES = 512 << 20
+    FIELDS = ['scale', 'red', 'green', 'blue', 'pixels']
+
+    ## Default location of the cache.
+    def defaultPath():
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'o3meter', 'cache.sqlite')
+
+    ## Parameters a file is decoded with, as the suffix of its digest.
+    def decodeParams(fileName):
+        if fileName.lower().endswith(RAW_EXTENSIONS):
+            return ''.join('/' + p for p in [rawDecoder()] + DCRAW_ARGS)
+        return ''
+
+    ## Digest of a file: the SHA-256 of its contents and the parameters it is
+    # decoded with.
+    # @param fileName name of the file
+    # @returns digest string
+    @STATS.timed('hash')
+    def fileDigest(fileName):
+        digest = hashlib.sha256()
+        with open(fileName, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest() + ResultCache.decodeParams(fileName)
+
+    ## Key of a file digest for a profile.
+    # @param digest see fileDigest
+    # @param profile Profile (default: the current one)
+    # @returns key string
+    def profileKey(digest, profile=None):
+        return digest + ':' + ','.join(str(v) for v in (profile or PROFILE).values())
+
+    ## Key of a file for the current processing parameters.
+    # @param fileName name of the file
+    # @returns key string
+    def fileKey(fileName):
+        return ResultCache.profileKey(ResultCache.fileDigest(fileName))
+
+    ## Digest of the file a key was made for.
+    def keyDigest(key):
+        return key.rpartition(':')[0]
+
+    ## @param path database file (default: see defaultPath)
+    # @param maxBytes maximum size of the stored entries
+    def __init__(self, path=None, maxBytes=MAX_BYTES):
+        self.path = path or ResultCache.defaultPath()
+        self.maxBytes = maxBytes
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+                             key TEXT PRIMARY KEY, scale INTEGER, red INTEGER, green INTEGER,
+                             blue INTEGER, pixels INTEGER, width INTEGER, height INTEGER,
+                             preview BLOB, size INTEGER, accessed REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS histograms (
+                             digest TEXT PRIMARY KEY, data BLOB, size INTEGER, accessed REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS histograms_accessed ON histograms (accessed)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                             path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_hash ON files (hash)")
+        self.db.commit()
+
+    ## Digest of a file, see fileDigest. Files whose histogram was stored are
+    # not read again while their size and modification time do not change.
+    # @param fileName name of the file
+    # @returns digest string
+    def digest(self, fileName):
+        st = os.stat(fileName)
+        row = self.db.execute("SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ?",
+                              (os.path.abspath(fileName), st.st_size, st.st_mtime_ns)).fetchone()
+        if row == None :
+            return ResultCache.fileDigest(fileName)
+        return row[0] + ResultCache.decodeParams(fileName)
+
+    ## Looks up an entry.
+    # @param key see fileKey
+    # @param preview also return the preview
+    # @param touch update its access time, otherwise it is left to the
+    # caller (see touch), so processes that only read the cache never wait
+    # for the write lock
+    # @returns dictionary with the fields in FIELDS and, if requested and
+    # stored, 'preview' (numpy array, BGR), or None if not cached
+    @STATS.timed('cache')
+    def get(self, key, preview=False, touch=True):
+        row = self.db.execute("SELECT scale, red, green, blue, pixels, width, height, "
+                              + ("preview" if preview else "NULL")
+                              + " FROM results WHERE key = ?", (key,)).fetchone()
+        if row == None :
+            STATS.count('cache misses')
+            return None
+        STATS.count('cache hits')
+        if touch :
+            self.touch([key])
+
+        entry = dict(zip(ResultCache.FIELDS, row[:5]))
+        width, height, data = row[5:]
+        if data != None :
+            entry['preview'] = numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint8).reshape(height, width, 3)
+        return entry
+
+    ## Stores an entry, replacing the previous one with the same key.
+    # @param key see fileKey
+    # @param result dictionary with the fields in FIELDS
+    # @param image numpy array (BGR) with the picture to keep a preview of
+    @STATS.timed('cache')
+    def put(self, key, result, image=None):
+        width = height = data = None
+        if image is not None :
+            factor = max(1, -(-max(image.shape[:2]) // ResultCache.PREVIEW_SIZE))
+            preview = downsample(image, factor) if factor > 1 else numpy.ascontiguousarray(image[:, :, :3])
+            height, width = preview.shape[:2]
+            data = zlib.compress(preview.tobytes(), 1)
+        size = len(key) + 64 + (len(data) if data != None else 0)
+
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [key] + [result[f] for f in ResultCache.FIELDS]
+                        + [width, height, data, size, time.time()])
+        self.evict()
+        self.db.commit()
+
+    ## Looks up the histogram of a file.
+    # @param digest see fileDigest
+    # @param touch see get
+    # @returns ChannelHistogram, or None if not cached
+    @STATS.timed('cache')
+    def histogram(self, digest, touch=True):
+        row = self.db.execute("SELECT data FROM histograms WHERE digest = ?", (digest,)).fetchone()
+        if row == None :
+            return None
+        STATS.count('histogram hits')
+        if touch :
+            self.db.execute("UPDATE histograms SET accessed = ? WHERE digest = ?", (time.time(), digest))
+            self.db.commit()
+        return ChannelHistogram.fromBytes(row[0])
+
+    ## Updates the access time of some entries, and of the histograms of their
+    # files, in a single transaction.
+    # @param keys list of keys, see profileKey
+    @STATS.timed('cache')
+    def touch(self, keys):
+        if not keys :
+            return
+        now = time.time()
+        self.db.executemany("UPDATE results SET accessed = ? WHERE key = ?", [(now, key) for key in keys])
+        self.db.executemany("UPDATE histograms SET accessed = ? WHERE digest = ?",
+                            [(now, ResultCache.keyDigest(key)) for key in keys])
+        self.db.commit()
+
+    ## Stores the histogram of a file.
+    # @param digest see fileDigest
+    # @param hist ChannelHistogram of the picture
+    # @param fileName name of the file, remembered with its digest (see digest)
+    @STATS.timed('cache')
+    def putHistogram(self, digest, hist, fileName=None):
+        data = hist.toBytes()
+        self.db.execute("INSERT OR REPLACE INTO histograms VALUES (?, ?, ?, ?)",
+                        (digest, data, len(digest) + 32 + len(data), time.time()))
+        if fileName != None :
+            st = os.stat(fileName)
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                            (os.path.abspath(fileName), st.st_size, st.st_mtime_ns,
+                             digest[:len(digest) - len(ResultCache.decodeParams(fileName))]))
+        self.evict()
+        self.db.commit()
+
+    ## Removes the least recently used entries (results and histograms) until
+    # the cache fits in maxBytes. The digests remembered for the files whose
+    # histogram is removed go with it, so the files table does not grow
+    # without bound either.
+    def evict(self):
+        total = self.db.execute("SELECT (SELECT COALESCE(SUM(size), 0) FROM results)"
+                                " + (SELECT COALESCE(SUM(size), 0) FROM histograms)").fetchone()[0]
+        if total <= self.maxBytes :
+            return
+        old = {'results': [], 'histograms': []}
+        for table, key, size, accessed in self.db.execute("SELECT 'results', key, size, accessed FROM results UNION ALL "
+                                                "SELECT 'histograms', digest, size, accessed FROM histograms "
+                                                "ORDER BY accessed"):
+            if total <= self.maxBytes :
+                break
+            old[table].append((key,))
+            total -= size
+        self.db.executemany("DELETE FROM results WHERE key = ?", old['results'])
+        self.db.executemany("DELETE FROM histograms WHERE digest = ?", old['histograms'])
+        # The files table holds the hashes without the decoding parameters
+        self.db.executemany("DELETE FROM files WHERE hash = ?",
+                            [(digest.partition('/')[0],) for digest, in old['histograms']])
+
+    def close(self):
+        self.db.close()
+
+################################################################################
+#
+# Spool of decoded pictures, so an archive can be analysed again (e.g. with
+# other thresholds) without decoding it again.
+#
+# Every picture is saved as a NumPy .npy file holding its BGR pixels (uint8,
+# without alpha) and later read back as a read-only memory map: the pixels are
+# paged in from the OS page cache as they are processed, several worker
+# processes share the same pages, and nothing stays resident once a picture is
+# done. Entries are named after the path, size and modification time of the
+# file (and the RAW decoder), so the picture is never read to look it up; an
+# entry is written to a temporary file and renamed, so concurrent workers never
+# see it half written. Stale entries are not removed: delete the directory to
+# reclaim the space.
+#
+class DecodedSpool():
+
+    ## Default location of the spool.
+    def defaultPath():
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'o3meter', 'spool')
+
+    ## @param path directory of the spool (default: see defaultPath)
+    def __init__(self, path=None):
+        self.path = path or DecodedSpool.defaultPath()
+        os.makedirs(self.path, exist_ok=True)
+
+    ## Name of the entry of a file.
+    # @param fileName name of the file
+    # @returns path of the entry
+    def entryPath(self, fileName):
+        st = os.stat(fileName)
+        params = [os.path.abspath(fileName), st.st_size, st.st_mtime_ns]
+        if fileName.lower().endswith(RAW_EXTENSIONS):
+            params += [rawDecoder()] + DCRAW_ARGS
+        digest = hashlib.sha256(repr(params).encode()).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + '.npy')
+
+    ## Returns the pixels of a picture, decoding it and saving it in the spool
+    # the first time.
+    # @param fileName name of the file
+    # @returns numpy array (BGR) of shape (height, width, 3), read-only if it
+    # was mapped from the spool
+    def array(self, fileName):
+        path = self.entryPath(fileName)
+        try:
+            arr = numpy.load(path, mmap_mode='r')
+            STATS.count('spool hits')
+            return arr
+        except (OSError, ValueError):
+            pass
+
+        STATS.count('spool misses')
+        arr = imageToArray(decodeImage(fileName))
+        self.put(path, arr)
+        return arr
+
+    ## Saves the pixels of a picture. Failing to write it (e.g. a full disk)
+    # is not an error, the picture is just not spooled.
+    # @param path path of the entry, see entryPath
+    # @param arr numpy array (BGR) with the picture
+    @STATS.timed('spool')
+    def put(self, path, arr):
+        temp = path + "." + str(os.getpid()) + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            out = numpy.lib.format.open_memmap(temp, mode='w+', dtype=numpy.uint8, shape=arr.shape[:2] + (3,))
+            out[...] = arr[:, :, :3]
+            out.flush()
+            del out
+            os.replace(temp, path)
+        except OSError:
+            STATS.count('spool errors')
+            with contextlib.suppress(OSError):
+                os.remove(temp)
+
+################################################################################
+#
+# Store of the measurements, replacing the old ozone.log text file.
+#
+# Every measurement (whole picture or selected region) is a row of a SQLite
+# database in WAL mode with its time, station, file, Ozone Scale value, mean
+# color, number of pixels, region, thresholds and profile. Regions are given
+# in pixels of the picture they were selected on, whose size is also recorded;
+# whole picture measurements have no region. Thresholds are recorded when they
+# were applied: always for whole pictures, for regions only if the result says
+# so (detected strips). The profile is recorded with every row, by name and by
+# its values, as a name may be given to other values later. Rows are indexed
+# by station and time.
+#
+# Measurements are buffered and written in batches of BATCH_SIZE rows, or when
+# flush() or close() are called.
+#
+class MeasurementStore():
+    BATCH_SIZE = 256
+    SERIES_BLOCK = 1 << 16
+    COLUMNS = ['time', 'station', 'file', 'scale', 'red', 'green', 'blue', 'pixels',
+               'x0', 'y0', 'x1', 'y1', 'width', 'height', 'dark_threshold', 'bright_threshold',
+               'estimate', 'bound', 'profile', 'profile_values']
+
+    ## Default location of the store.
+    def defaultPath():
+        base = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+        return os.path.join(base, 'o3meter', 'measurements.sqlite')
+
+    ## Default name of the station: $O3METER_STATION or the host name.
+    def defaultStation():
+        return os.environ.get('O3METER_STATION') or socket.gethostname()
+
+    ## @param path database file (default: see defaultPath)
+    # @param station name of the station recorded with the measurements
+    def __init__(self, path=None, station=None):
+        self.path = path or MeasurementStore.defaultPath()
+        self.station = station or MeasurementStore.defaultStation()
+        self.pending = []
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS measurements (
+                             id INTEGER PRIMARY KEY, time REAL NOT NULL, station TEXT NOT NULL,
+                             file TEXT NOT NULL, scale INTEGER, red INTEGER, green INTEGER,
+                             blue INTEGER, pixels INTEGER, x0 INTEGER, y0 INTEGER, x1 INTEGER,
+                             y1 INTEGER, width INTEGER, height INTEGER, dark_threshold INTEGER,
+                             bright_threshold INTEGER, estimate INTEGER NOT NULL DEFAULT 0, bound REAL,
+                             profile TEXT, profile_values TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS measurements_station_time ON measurements (station, time)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS measurements_time ON measurements (time)")
+        self.db.commit()
+
+    ## Adds a measurement.
+    # @param fileName measured file
+    # @param result dictionary with 'scale', 'red', 'green', 'blue' and
+    # 'pixels', and optionally 'region' (x0, y0, x1, y1), 'width', 'height'
+    # and, for the estimates of the fast mode, 'estimate' (1) and 'bound'.
+    # 'profile' gives the Profile it was measured with (default: the current
+    # one), recorded as its name and its values separated by commas, in the
+    # order of Profile.FIELDS.
+    # @param timestamp time of the measurement (default: now)
+    def add(self, fileName, result, timestamp=None):
+        profile = result.get('profile') or PROFILE
+        region = result.get('region')
+        if region == None :
+            region = (None,) * 4
+            thresholds = (profile.darkThreshold, profile.brightThreshold)
+        else:
+            thresholds = result.get('thresholds', (None, None))
+        estimate = 1 if result.get('estimate') else 0
+        # The bound of an estimate is empty when the deviation is unknown
+        bound = result.get('bound') if estimate else None
+
+        self.pending.append((time.time() if timestamp == None else timestamp, self.station, fileName,
+                             result['scale'], result['red'], result['green'], result['blue'],
+                             result['pixels']) + tuple(region)
+                            + (result.get('width'), result.get('height')) + thresholds
+                            + (estimate, None if bound == '' else bound)
+                            + (profile.name, ','.join(str(v) for v in profile.values())))
+        if len(self.pending) >= MeasurementStore.BATCH_SIZE :
+            self.flush()
+
+    ## Writes the buffered measurements.
+    @STATS.timed('store')
+    def flush(self):
+        if not self.pending :
+            return
+        STATS.count('measurements stored', len(self.pending))
+        self.db.executemany("INSERT INTO measurements (" + ", ".join(MeasurementStore.COLUMNS)
+                            + ") VALUES (" + ", ".join("?" * len(MeasurementStore.COLUMNS)) + ")",
+                            self.pending)
+        self.db.commit()
+        self.pending = []
+
+    ## Builds the WHERE clause of a query.
+    # @param conditions list of conditions with their parameters, those whose
+    # parameter is None are left out
+    # @returns tuple with the clause (empty if there are no conditions) and
+    # the list of parameters
+    def where(conditions):
+        conditions = [(condition, value) for condition, value in conditions if value != None]
+        if not conditions :
+            return "", []
+        return (" WHERE " + " AND ".join(condition for condition, value in conditions),
+                [value for condition, value in conditions])
+
+    ## Returns the measurements in a time range, oldest first.
+    # @param station only this station (default: all)
+    # @param since start time (timestamp, inclusive)
+    # @param until end time (timestamp, exclusive)
+    # @returns list of dictionaries with the keys in COLUMNS
+    def query(self, station=None, since=None, until=None):
+        self.flush()
+        where, params = MeasurementStore.where([("station = ?", station), ("time >= ?", since),
+                                                ("time < ?", until)])
+        sql = "SELECT " + ", ".join(MeasurementStore.COLUMNS) + " FROM measurements" + where
+        sql += " ORDER BY time, id"
+        return [dict(zip(MeasurementStore.COLUMNS, row)) for row in self.db.execute(sql, params)]
+
+    ## Returns the Ozone Scale values measured after a given row as arrays,
+    # in the order they were stored. Rows are read in blocks of SERIES_BLOCK,
+    # so millions of them never exist as Python tuples at once.
+    # @param afterId only the rows with a larger id
+    # @param station only this station (default: all)
+    # @param since start time (timestamp, inclusive)
+    # @param until end time (timestamp, exclusive)
+    # @param files also return the file names
+    # @param estimates also return the estimates of the fast mode
+    # @returns dictionary of numpy arrays: 'id', 'time', 'station' (objects),
+    # 'scale' and, if requested, 'file' (objects)
+    @STATS.timed('store')
+    def series(self, afterId=0, station=None, since=None, until=None, files=False, estimates=False):
+        self.flush()
+        columns = [('id', numpy.int64), ('time', numpy.float64), ('station', object), ('scale', numpy.float64)]
+        if files :
+            columns.append(('file', object))
+        where, params = MeasurementStore.where([("id > ?", afterId), ("station = ?", station),
+                                                ("time >= ?", since), ("time < ?", until),
+                                                ("estimate = ?", None if estimates else 0)])
+        cursor = self.db.execute("SELECT " + ", ".join(name for name, dtype in columns) + " FROM measurements"
+                                 + where + " AND scale IS NOT NULL ORDER BY id", params)
+
+        blocks = [[] for column in columns]
+        for rows in iter(lambda: cursor.fetchmany(MeasurementStore.SERIES_BLOCK), []):
+            for block, values, (name, dtype) in zip(blocks, zip(*rows), columns):
+                block.append(numpy.array(values, dtype=dtype))
+        return {name: numpy.concatenate(block) if block else numpy.empty(0, dtype=dtype)
+                for block, (name, dtype) in zip(blocks, columns)}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+################################################################################
+#
+# Aggregation of the stored measurements over time.
+#
+# The Ozone Scale values are grouped by station and day (local time) into
+# running sums: number of measurements, sum, sum of squares, lowest and
+# highest value, and number of outliers. The sums are kept in arrays of
+# stations x days, and everything reported (daily statistics, statistics of
+# the trailing window of the last days, trend of every station) is computed
+# from them, never from the rows. New measurements are read from the store by
+# row id and added to the sums with a few numpy operations (see update), so
+# the history is only read once and keeping up with new measurements costs
+# the rows just stored.
+#
+# A measurement is an outlier when it is more than sigmas standard deviations
+# away from the mean of its station over the window days before its own, if
+# at least MIN_BASELINE measurements were made in those days. The standard
+# deviation counts as one unit at least, as the values are integers. Only
+# previous days are compared, so measurements stored in time order never
+# change the flags already given.
+#
+class SeriesAggregator():
+    WINDOW = 7
+    SIGMAS = 3.0
+    MIN_BASELINE = 5
+    SUMS = {'count': 0, 'total': 0.0, 'squares': 0.0, 'low': numpy.inf, 'high': -numpy.inf, 'outliers': 0}
+
+    ## Day numbers (days since 1970-01-01, local time) of timestamps. The UTC
+    # offset is looked up once for every hour between the first and the last
+    # timestamp.
+    # @param times numpy array of timestamps
+    # @returns numpy array of day numbers
+    def localDays(times):
+        hours = (times // 3600).astype(numpy.int64)
+        first, last = int(hours.min()), int(hours.max())
+        offsets = numpy.array([time.localtime(hour * 3600).tm_gmtoff for hour in range(first, last + 1)],
+                              dtype=numpy.float64)
+        return ((times + offsets[hours - first]) // 86400).astype(numpy.int64)
+
+    ## @returns datetime.date of a day number
+    def dayDate(day):
+        return datetime.date(1970, 1, 1) + datetime.timedelta(days=int(day))
+
+    ## Mean and standard deviation from sums.
+    # @returns tuple with the count, the mean and the standard deviation (NaN
+    # where the count is 0)
+    def moments(count, total, squares):
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            std = numpy.sqrt(numpy.maximum(squares / count - mean * mean, 0))
+        return count, mean, std
+
+    ## @param window days of the trailing window
+    # @param sigmas distance from the mean of the outliers, in standard
+    # deviations
+    def __init__(self, window=WINDOW, sigmas=SIGMAS):
+        self.window = window
+        self.sigmas = sigmas
+        self.stations = []
+        self.stationIndex = {}
+        self.firstDay = 0
+        self.lastId = 0
+        self.sums = {name: numpy.full((0, 0), fill) for name, fill in SeriesAggregator.SUMS.items()}
+
+    ## @returns number of days covered by the sums
+    def days(self):
+        return self.sums['count'].shape[1]
+
+    ## Numbers of the stations of some measurements. New stations are
+    # appended to stations.
+    # @param names numpy array of station names
+    # @returns numpy array of station numbers
+    def stationCodes(self, names):
+        codes = numpy.fromiter((self.stationIndex.setdefault(name, len(self.stationIndex)) for name in names.tolist()),
+                               dtype=numpy.int64, count=len(names))
+        self.stations = list(self.stationIndex)
+        return codes
+
+    ## Grows the sums to cover all the stations and a range of days.
+    # @param firstDay first day number
+    # @param lastDay last day number (inclusive)
+    def grow(self, firstDay, lastDay):
+        if self.days() == 0 :
+            self.firstDay = firstDay
+        before = max(0, self.firstDay - firstDay)
+        after = max(0, lastDay - (self.firstDay + self.days() - 1))
+        stations = len(self.stations) - self.sums['count'].shape[0]
+        if before or after or stations :
+            for name, fill in SeriesAggregator.SUMS.items():
+                self.sums[name] = numpy.pad(self.sums[name], ((0, stations), (before, after)),
+                                            constant_values=fill)
+            self.firstDay -= before
+
+    ## Statistics of the trailing windows of every station and day.
+    # @param current include the day itself (the day and the window - 1 days
+    # before it) or not (the window days before it)
+    # @returns tuple of arrays (stations x days): count, mean and standard
+    # deviation, NaN where there are no measurements
+    def windowStatistics(self, current=True):
+        end = numpy.arange(self.days()) + (1 if current else 0)
+        start = numpy.maximum(end - self.window, 0)
+        sums = []
+        for name in ('count', 'total', 'squares'):
+            cumulative = numpy.zeros((self.sums[name].shape[0], self.days() + 1), dtype=self.sums[name].dtype)
+            numpy.cumsum(self.sums[name], axis=1, out=cumulative[:, 1:])
+            sums.append(cumulative[:, end] - cumulative[:, start])
+        return SeriesAggregator.moments(*sums)
+
+    ## Adds measurements to the sums and flags the outliers among them. The
+    # rows already added (id not above lastId) are left out.
+    # @param rows dictionary of arrays, as returned by MeasurementStore.series
+    # @returns the rows added, with the arrays 'day' (day numbers), 'outlier'
+    # (booleans), 'baseline' and 'spread' (mean and standard deviation of the
+    # window before the day, NaN if there were too few measurements in it)
+    @STATS.timed('series')
+    def add(self, rows):
+        new = rows['id'] > self.lastId
+        rows = {name: values[new] for name, values in rows.items()}
+        if rows['id'].size == 0 :
+            rows.update(day=numpy.empty(0, dtype=numpy.int64), outlier=numpy.empty(0, dtype=bool),
+                        baseline=numpy.empty(0), spread=numpy.empty(0))
+            return rows
+
+        stations = self.stationCodes(rows['station'])
+        days = SeriesAggregator.localDays(rows['time'])
+        self.grow(int(days.min()), int(days.max()))
+        index = days - self.firstDay
+        cells = stations * self.days() + index
+        scales = rows['scale']
+        shape = self.sums['count'].shape
+        for name, weights in (('count', None), ('total', scales), ('squares', scales * scales)):
+            self.sums[name] += numpy.bincount(cells, weights, shape[0] * shape[1]).reshape(shape)
+        numpy.minimum.at(self.sums['low'].reshape(-1), cells, scales)
+        numpy.maximum.at(self.sums['high'].reshape(-1), cells, scales)
+
+        count, mean, std = (values[stations, index] for values in self.windowStatistics(current=False))
+        enough = count >= SeriesAggregator.MIN_BASELINE
+        baseline = numpy.where(enough, mean, numpy.nan)
+        spread = numpy.where(enough, std, numpy.nan)
+        outlier = enough & (numpy.abs(scales - mean) > self.sigmas * numpy.maximum(std, 1))
+        self.sums['outliers'] += numpy.bincount(cells[outlier], minlength=shape[0] * shape[1]).reshape(shape)
+
+        self.lastId = int(rows['id'].max())
+        STATS.count('series rows', rows['id'].size)
+        rows.update(day=days, outlier=outlier, baseline=baseline, spread=spread)
+        return rows
+
+    ## Adds the measurements stored since the last update.
+    # @param store MeasurementStore
+    # @param station, since, until, files, estimates see MeasurementStore.series
+    # @returns see add
+    def update(self, store, station=None, since=None, until=None, files=False, estimates=False):
+        return self.add(store.series(self.lastId, station, since, until, files, estimates))
+
+    ## Daily statistics and statistics of the trailing window of every station
+    # and day.
+    # @returns dictionary of arrays (stations x days): 'count', 'mean', 'std',
+    # 'min', 'max', 'outliers', 'window_count', 'window_mean' and
+    # 'window_std', NaN where there are no measurements
+    def statistics(self):
+        count, mean, std = SeriesAggregator.moments(self.sums['count'], self.sums['total'], self.sums['squares'])
+        empty = count == 0
+        result = {'count': count, 'mean': mean, 'std': std,
+                  'min': numpy.where(empty, numpy.nan, self.sums['low']),
+                  'max': numpy.where(empty, numpy.nan, self.sums['high']), 'outliers': self.sums['outliers']}
+        result.update(zip(('window_count', 'window_mean', 'window_std'), self.windowStatistics()))
+        return result
+
+    ## Statistics of a station over its last days.
+    # @param station name of the station
+    # @param days number of days, today included
+    # @returns dictionary of arrays (days) with the day numbers ('day') and
+    # the keys of statistics, NaN on the days without measurements
+    def recent(self, station, days):
+        today = int(SeriesAggregator.localDays(numpy.array([time.time()]))[0])
+        result = {'day': numpy.arange(today - days + 1, today + 1)}
+        index = result['day'] - self.firstDay
+        inside = (index >= 0) & (index < self.days())
+        row = self.stationIndex.get(station)
+        for name, values in self.statistics().items():
+            result[name] = numpy.full(days, numpy.nan)
+            if row != None :
+                result[name][inside] = values[row, index[inside]]
+        return result
+
+    ## Trend of every station: least squares line of its values against the
+    # day they were measured.
+    # @returns dictionary of arrays (stations): 'count', 'days' (days with
+    # measurements), 'first' and 'last' (day numbers), 'mean', 'trend' (Ozone
+    # Scale units per day, NaN if all the measurements are from one day) and
+    # 'outliers'
+    def trends(self):
+        count, total = self.sums['count'], self.sums['total']
+        t = numpy.arange(self.days(), dtype=numpy.float64)
+        n, sumT, sumTT = count.sum(axis=1), count @ t, count @ (t * t)
+        sumY, sumTY = total.sum(axis=1), total @ t
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            denominator = n * sumTT - sumT * sumT
+            trend = numpy.where(denominator > 0, (n * sumTY - sumT * sumY) / denominator, numpy.nan)
+            mean = sumY / n
+        measured = count > 0
+        if self.days() == 0 :
+            # Nothing measured yet: no stations either
+            first = last = numpy.empty(0, dtype=numpy.int64)
+        else:
+            first = self.firstDay + numpy.argmax(measured, axis=1)
+            last = self.firstDay + self.days() - 1 - numpy.argmax(measured[:, ::-1], axis=1)
+        return {'count': n, 'days': measured.sum(axis=1), 'first': first, 'last': last,
+                'mean': mean, 'trend': trend, 'outliers': self.sums['outliers'].sum(axis=1)}
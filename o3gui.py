@@ -0,0 +1,1254 @@
+# -*- coding: utf-8 -*-
+
+# O3METER
+# Copyright (C) 2018 Orlando Garcia-Feal - Universidade de Vigo - orlando@uvigo.es
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##
+# Graphical interface of O3METER.
+#
+
+import sys, os, sqlite3, concurrent.futures
+import numpy
+
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import *
+from PyQt5.QtCore import *
+
+import o3core
+from o3core import *
+
+################################################################################
+#
+# Multi-resolution pyramid of a picture for display. Level 0 is the picture
+# itself and every other level halves the previous one. When the picture is
+# shown reduced, it is painted from the smallest level that is still at least
+# as large as the displayed size, so painting never has to scale down much
+# more pixels than it paints. Levels are built the first time they are needed
+# and stored as RGB32, the format QPainter scales fastest.
+#
+class ImagePyramid():
+    MIN_SIZE = 256
+
+    ## @param image QImage with the picture (level 0)
+    # @param arr numpy array with the image data (BGR)
+    def __init__(self, image, arr):
+        self.levels = [image]
+        self.arr = arr
+
+    ## Returns the level to paint the picture at a given scale.
+    # @param scale displayed size divided by the size of the picture
+    # @returns QImage of the level
+    def level(self, scale):
+        index = 0
+        while scale <= 0.5 / (1 << index) and index < 16:
+            index += 1
+
+        while len(self.levels) <= index:
+            last = self.levels[-1]
+            if max(last.width(), last.height()) <= ImagePyramid.MIN_SIZE or min(last.width(), last.height()) < 2 :
+                break
+            small = downsample(self.arr, 2)
+            image = QImage(small.shape[1], small.shape[0], QImage.Format_RGB32)
+            image.fill(Qt.black)
+            self.arr = ImageBuffer(image, dropAlpha=False, writable=True).array()
+            self.arr[...] = small
+            self.levels.append(image)
+        return self.levels[min(index, len(self.levels) - 1)]
+
+################################################################################
+#
+# This widget will show a pointer over a Ozone color scale. This scale vary from
+# yellow to blue.
+#
+class ScaleWidget(QWidget):
+    hue = 0
+    
+    def __init__(self, parent):
+        super().__init__(parent)
+
+    ## QT Slot. Updates the widget color value.
+    def updatePointer(self, color):
+        self.color = color
+        self.update()
+
+    ## Draws the widget's contents when a QPaintEvent occurs.
+    def paintEvent(self, paintEvent):
+        painter = QPainter(self)
+        gradient = QLinearGradient(0, 0, self.width(), 0);
+
+        # Standard 0-360 hue scale
+        # for i in range(0, 7):
+        #     gradient.setColorAt(i * (1 / 6), QColor.fromHsv(60 * i if i < 6 else 359, 255, 255));
+
+        # Defines the gradient of the Ozone scale
+        gradient.setColorAt(0, QColor.fromHsv(60, 255, 255));
+        gradient.setColorAt(1/3, QColor.fromHsv(0, 255, 255));
+        gradient.setColorAt(2/3., QColor.fromHsv(300, 255, 255));
+        gradient.setColorAt(1, QColor.fromHsv(240, 255, 255));
+        
+        painter.fillRect(0, 0, self.width(), self.height(), gradient);
+
+        colordisp = (self.width() * self.color) / 180
+        points = QPolygonF([QPointF(-10.0 + colordisp, 0.0),
+                            QPointF(0.0 + colordisp, 10.0),
+                            QPointF(10.0 + colordisp, 0.0)])
+
+        painter.setBrush(Qt.SolidPattern)
+        painter.drawPolygon(points)
+
+################################################################################
+#
+# This widget shows the recent history of the station: the mean of every one
+# of the last DAYS days as a point colored like the Ozone Scale, the mean of
+# the trailing window (see SeriesAggregator) as a line, and the days with
+# outliers with a red mark at the top. The Ozone Scale goes from 0 at the
+# bottom to 180 at the top.
+#
+class SeriesWidget(QWidget):
+    DAYS = 60
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.series = None
+        self.setMinimumHeight(100)
+        self.setToolTip("Daily means of the last " + str(SeriesWidget.DAYS) + " days")
+
+    ## Qt Slot. Shows new statistics.
+    # @param series dictionary of arrays, see SeriesAggregator.recent
+    def setSeries(self, series):
+        self.series = series
+        self.update()
+
+    ## Draws the widget's contents when a QPaintEvent occurs.
+    def paintEvent(self, paintEvent):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().color(QPalette.Base))
+        painter.setPen(self.palette().color(QPalette.Mid))
+        painter.drawRect(0, 0, self.width() - 1, self.height() - 1)
+        if self.series == None or numpy.isnan(self.series['mean']).all() :
+            painter.setPen(self.palette().color(QPalette.Text))
+            painter.drawText(self.rect(), Qt.AlignCenter, "No measurements")
+            return
+
+        painter.setRenderHint(QPainter.Antialiasing)
+        step = self.width() / len(self.series['day'])
+        xs = (numpy.arange(len(self.series['day'])) + 0.5) * step
+        ys = (1 - numpy.clip(self.series['mean'], 0, 180) / 180) * (self.height() - 1)
+        windowYs = (1 - numpy.clip(self.series['window_mean'], 0, 180) / 180) * (self.height() - 1)
+
+        # Mean of the trailing window, broken where it has no measurements
+        path = QPainterPath()
+        drawing = False
+        for x, y in zip(xs.tolist(), windowYs.tolist()):
+            if y != y :
+                drawing = False
+            elif drawing :
+                path.lineTo(x, y)
+            else:
+                path.moveTo(x, y)
+                drawing = True
+        painter.setPen(QPen(self.palette().color(QPalette.Text), 1))
+        painter.drawPath(path)
+
+        radius = max(2.0, min(4.0, step / 2))
+        painter.setPen(Qt.NoPen)
+        for x, y, mean, outliers in zip(xs.tolist(), ys.tolist(), self.series['mean'].tolist(),
+                                        self.series['outliers'].tolist()):
+            if outliers > 0 :
+                painter.fillRect(QRectF(x - radius / 2, 1, radius, 6), Qt.red)
+            if mean == mean :
+                painter.setBrush(QColor.fromHsv(o3core.PROFILE.hue(int(round(mean))), 255, 255))
+                painter.drawEllipse(QPointF(x, y), radius, radius)
+
+################################################################################
+#
+# Background jobs of the viewer.
+#
+# Every computation of the viewer (decoding and analysing a picture, measuring
+# a selection, the heatmap, the strips) runs as a job in a shared pool of
+# threads, so the window keeps responding while it works. Jobs are grouped by
+# kind and only the newest job of each kind matters: submitting a job cancels
+# the previous one of the same kind, so a quick sequence of selections, or of
+# opened files, only delivers the last result.
+#
+# Job functions run in a worker thread and must not touch any widget. They
+# receive the Job and report their progress through it, which is also where
+# they are interrupted when cancelled. Their results are delivered in the GUI
+# thread.
+#
+class JobCancelled(Exception):
+    pass
+
+class Job():
+
+    ## @param scheduler JobScheduler running the job
+    # @param kind kind of job, see JobScheduler.submit
+    # @param label description shown while it runs
+    # @param function called as function(job, *args) in a worker thread
+    # @param args arguments of the function
+    # @param done called in the GUI thread with the result of the function
+    def __init__(self, scheduler, kind, label, function, args, done):
+        self.scheduler = scheduler
+        self.kind = kind
+        self.label = label
+        self.function = function
+        self.args = args
+        self.done = done
+        self.cancelled = False
+
+    ## Asks the job to stop. It is not delivered anyway.
+    def cancel(self):
+        self.cancelled = True
+
+    ## Reports the progress of the job. Called from the job function.
+    # @param value work done
+    # @param maximum total work (0 if unknown)
+    # @param label new description of the job
+    # @throws JobCancelled if the job was cancelled
+    def progress(self, value, maximum, label=None):
+        if self.cancelled :
+            raise JobCancelled()
+        if label != None :
+            self.label = label
+        self.scheduler.progressed.emit(self, value, maximum)
+
+    ## Runs the job function in the worker thread.
+    def run(self):
+        result = error = None
+        try:
+            with STATS.timer('job ' + self.kind):
+                self.progress(0, 0)
+                result = self.function(self, *self.args)
+        except JobCancelled:
+            self.cancelled = True
+            STATS.count('jobs cancelled')
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        self.scheduler.jobFinished.emit(self, result, error)
+
+class JobScheduler(QObject):
+    # The job is running or finished, for progress reports
+    started = pyqtSignal(object)
+    progressed = pyqtSignal(object, int, int)
+    finished = pyqtSignal(object)
+    # A job failed: kind and error message
+    failed = pyqtSignal(str, str)
+    # Emitted by the workers, delivered in the GUI thread
+    jobFinished = pyqtSignal(object, object, object)
+
+    ## @param parent parent QObject
+    # @param workers number of threads (default: the number of CPUs, up to 4)
+    def __init__(self, parent=None, workers=None):
+        super().__init__(parent)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1))
+        self.current = {}
+        self.jobFinished.connect(self.deliver)
+
+    ## Starts a job, cancelling the previous one of the same kind.
+    # @param kind kind of job (e.g. 'image', 'region')
+    # @param label description shown while it runs
+    # @param function called as function(job, *args) in a worker thread
+    # @param args arguments of the function
+    # @param done called in the GUI thread with the result of the function
+    # @returns Job
+    def submit(self, kind, label, function, *args, done=None):
+        self.cancel(kind)
+        job = Job(self, kind, label, function, args, done)
+        self.current[kind] = job
+        self.executor.submit(job.run)
+        self.started.emit(job)
+        return job
+
+    ## Cancels the jobs of a kind, or all of them.
+    # @param kind kind of job (default: all)
+    def cancel(self, kind=None):
+        for job in [job for job in self.current.values() if kind == None or job.kind == kind]:
+            job.cancel()
+            del self.current[job.kind]
+            self.finished.emit(job)
+
+    ## @returns list of the running jobs
+    def running(self):
+        return list(self.current.values())
+
+    ## Qt Slot: delivers the result of a job, unless it was cancelled or
+    # superseded meanwhile.
+    def deliver(self, job, result, error):
+        if self.current.get(job.kind) is not job :
+            return
+        del self.current[job.kind]
+        self.finished.emit(job)
+        if job.cancelled :
+            return
+        if error != None :
+            self.failed.emit(job.kind, error)
+        elif job.done != None :
+            job.done(result)
+
+    ## Cancels all the jobs and waits for the threads to finish.
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=True)
+
+## Decodes and analyses a picture for the viewer. This is a job function.
+# @param job Job running it
+# @param fileName name of the file
+# @param dropAlpha see ImageBuffer
+# @param profile Profile the picture is measured with, taken when the job is
+# submitted, as the current one may change meanwhile
+# @returns dictionary with the file name ('file'), the ImageBuffer
+# ('buffer'), the IntegralImage ('integral'), the ImagePyramid ('pyramid'),
+# the measurement of the whole picture ('result') and its profile ('profile',
+# also in the measurement, see MeasurementStore.add)
+def analyseImage(job, fileName, dropAlpha, profile):
+    job.progress(0, 0, "Decoding " + os.path.basename(fileName) + "...")
+    if fileName.lower().endswith(RAW_EXTENSIONS):
+        # The histogram is obtained while the file is decoded
+        image, hist = readRaw(fileName, True, job.progress)
+    else:
+        image, hist = decodeImage(fileName), None
+
+    buffer = ImageBuffer(image, dropAlpha)
+    del image
+    arr = buffer.array()
+    job.progress(0, 0, "Computing...")
+    if hist == None :
+        hist = ChannelHistogram.fromArray(arr, job.progress)
+    integral = IntegralImage(arr)
+    job.progress(0, 0)
+    pyramid = ImagePyramid(buffer.image, arr)
+    pyramid.level(0)
+
+    result = profile.measure(hist)
+    result['profile'] = profile
+    return {'file': fileName, 'buffer': buffer, 'integral': integral, 'pyramid': pyramid,
+            'histogram': hist, 'result': result, 'profile': profile}
+
+## Opens a picture for the viewer: looks it up in the cache, with a
+# connection of its own, and decodes and analyses it (see analyseImage) if its
+# measurement and preview are not cached. Hashing the file, if needed, is done
+# here too, so nothing of it blocks the window. This is a job function.
+# @param job Job running it
+# @param cachePath database file of the ResultCache (None if disabled)
+# @param fileName name of the file
+# @param dropAlpha see ImageBuffer
+# @param profile see analyseImage
+# @returns dictionary with the file name ('file'), its digest ('digest', None
+# if unknown) and the profile ('profile'), and either the cached measurement
+# ('cached') with its preview ('preview', QImage) or the fields returned by
+# analyseImage
+def openImage(job, cachePath, fileName, dropAlpha, profile):
+    job.progress(0, 0, "Opening " + os.path.basename(fileName) + "...")
+    digest = cached = None
+    if cachePath != None :
+        try:
+            cache = ResultCache(cachePath)
+            try:
+                digest = cache.digest(fileName)
+                cached = cache.get(ResultCache.profileKey(digest, profile), preview=True)
+            finally:
+                cache.close()
+        except (OSError, sqlite3.Error) as e:
+            print("Cache lookup failed: " + str(e), file=sys.stderr)
+
+    if cached != None and 'preview' in cached :
+        preview = arrayToImage(cached.pop('preview'))
+        return {'file': fileName, 'digest': digest, 'profile': profile, 'cached': cached, 'preview': preview}
+    picture = analyseImage(job, fileName, dropAlpha, profile)
+    picture['digest'] = digest
+    return picture
+
+## Stores the measurement of a whole picture, with a preview, and its
+# histogram in the cache, with a connection of its own. This is a job
+# function.
+# @param job Job running it
+# @param cachePath database file of the ResultCache
+# @param digest digest of the file
+# @param profile Profile of the measurement
+# @param result measurement of the picture
+# @param arr numpy array with the picture, see ResultCache.put
+# @param histogram ChannelHistogram of the picture (None if unknown)
+# @param fileName name of the file
+def cacheImage(job, cachePath, digest, profile, result, arr, histogram, fileName):
+    cache = ResultCache(cachePath)
+    try:
+        cache.put(ResultCache.profileKey(digest, profile), result, arr)
+        if histogram != None :
+            cache.putHistogram(digest, histogram, fileName)
+    finally:
+        cache.close()
+
+## Reads the measurements stored after a given row, with a connection of its
+# own. This is a job function.
+# @param job Job running it
+# @param path database file of the MeasurementStore
+# @param afterId see MeasurementStore.series
+# @returns see MeasurementStore.series
+def readSeries(job, path, afterId):
+    store = MeasurementStore(path)
+    try:
+        return store.series(afterId)
+    finally:
+        store.close()
+
+################################################################################
+#
+# This widget implements a custom image viewer
+#
+# The picture is kept once, in the ImageBuffer shared with numpy, and painted
+# directly from it: no QPixmap copy is made. Only the exposed part of the
+# widget (usually the viewport of the scroll area) is painted, and reduced
+# views are painted from an ImagePyramid, so zooming and panning cost the
+# same whatever the size of the picture is.
+#
+# Optionally, a heatmap with the Ozone Scale value of every tile of the image
+# is painted over it, so uneven exposures are easy to spot. The values come
+# from the integral image, all the tiles at once. Detected strips are outlined
+# and numbered.
+#
+# Pictures are loaded and every measurement is computed by the shared
+# JobScheduler, so the window is never blocked.
+#
+class SelectableImage(QLabel):
+    rubberBand = 0
+    scaleFactor = 1.0
+    integral = None
+    image = QImage()
+    pyramid = None
+    fileName = None
+    dropAlpha = True
+    heatmap = None
+    heatmapEnabled = False
+    heatmapTile = 64
+    heatmapColors = None
+    strips = []
+    histogram = None
+    # Digest of the file shown (see ResultCache.fileDigest, None if unknown)
+    # and Profile of the measurement of the whole picture, which give the key
+    # of the measurement in the cache
+    digest = None
+    profile = None
+    # Only a cached preview of the picture is shown (see setMeasuredImage)
+    preview = False
+    hueCalculated = pyqtSignal(int)
+    huePreview = pyqtSignal(int)
+    imageMeasured = pyqtSignal(object)
+    measured = pyqtSignal(object)
+    imageChanged = pyqtSignal(str)
+    imageLoaded = pyqtSignal(str)
+    stripsDetected = pyqtSignal(object)
+    
+    ## @param widget parent widget
+    # @param jobs JobScheduler running the computations
+    def __init__(self, widget, jobs):
+        super().__init__(widget)
+        self.jobs = jobs
+
+    ## Scales the image by the given factor
+    # @param factor Zoom factor
+    # @returns Current zoom factor
+    def scale(self, factor):
+        self.scaleFactor = self.scaleFactor * factor
+        self.resize(self.scaleFactor * self.image.size())
+        return self.scaleFactor
+
+    ## Draws the exposed part of the image scaled to the size of the widget.
+    @STATS.timed('paint')
+    def paintEvent(self, paintEvent):
+        if self.image.isNull():
+            return
+        painter = QPainter(self)
+        rect = QRectF(paintEvent.rect())
+        sx = self.width() / self.image.width()
+        sy = self.height() / self.image.height()
+
+        # Source rectangle in pixels of the pyramid level
+        level = self.pyramid.level(min(sx, sy))
+        lx = level.width() / self.width()
+        ly = level.height() / self.height()
+        source = QRectF(rect.x() * lx, rect.y() * ly, rect.width() * lx, rect.height() * ly)
+        if level is not self.image :
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(rect, level, source)
+
+        if self.heatmap != None :
+            # Tiles are drawn at their size in the image, the last ones are
+            # clipped by the border of the widget, with sharp edges
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, False)
+            painter.drawImage(QRectF(0, 0, self.heatmap.width() * self.heatmapTile * sx,
+                                     self.heatmap.height() * self.heatmapTile * sy), self.heatmap)
+
+        if self.strips :
+            painter.setPen(QPen(Qt.red, 2))
+            for i, strip in enumerate(self.strips):
+                xo, yo, xd, yd = strip['region']
+                rect = QRectF(xo * sx, yo * sy, (xd - xo) * sx, (yd - yo) * sy)
+                painter.drawRect(rect)
+                painter.drawText(rect.adjusted(4, 4, 0, 0), Qt.AlignLeft | Qt.AlignTop,
+                                 str(i + 1) + ": " + str(strip['scale']))
+
+    ## Detects and measures all the strips of the image in the background.
+    # Every strip is reported as a measurement when done.
+    def detectStrips(self):
+        if self.integral == None :
+            return
+        self.jobs.submit('strips', "Detecting strips...", lambda job, arr: measureStrips(arr), self.arr,
+                         done=self.showStrips)
+
+    ## Shows the detected strips and reports them.
+    # @param strips list of results, see measureStrips
+    def showStrips(self, strips):
+        self.strips = strips
+        for i, strip in enumerate(self.strips):
+            print("Hue of strip " + str(i + 1) + ": " + str(strip['scale']))
+            self.measured.emit(strip)
+        self.update()
+        self.stripsDetected.emit(strips)
+
+    ## Measures the picture again with the current profile, from the histogram
+    # of the whole picture, and computes the heatmap and the strips again.
+    # @returns False if the histogram is not known, then the picture has to
+    # be loaded again to be measured
+    # @throws ValueError if no pixel is dark enough
+    def rescore(self):
+        SelectableImage.heatmapColors = None
+        self.updateHeatmap()
+        if self.strips :
+            self.detectStrips()
+        if self.histogram == None :
+            return False
+        result = o3core.PROFILE.measure(self.histogram)
+        self.profile = o3core.PROFILE
+        print("Hue of the stripe: " + str(result['scale']))
+        self.imageMeasured.emit(result)
+        self.measured.emit(result)
+        self.hueCalculated.emit(result['scale'])
+        return True
+
+    ## Shows or hides the heatmap overlay.
+    # @param enabled show the heatmap
+    # @param tile size of the tiles in pixels of the image (default: keep)
+    def setHeatmap(self, enabled, tile=None):
+        self.heatmapEnabled = enabled
+        if tile != None :
+            self.heatmapTile = tile
+        self.updateHeatmap()
+
+    ## Computes the heatmap of the current image in the background.
+    def updateHeatmap(self):
+        self.heatmap = None
+        self.jobs.cancel('heatmap')
+        if self.heatmapEnabled and self.integral != None :
+            self.jobs.submit('heatmap', "Computing the heatmap...", SelectableImage.heatmapIndices,
+                             self.integral, self.heatmapTile, done=self.showHeatmap)
+        self.update()
+
+    ## Ozone Scale value of every tile of an image, 181 for values out of the
+    # scale. This is a job function.
+    # @returns numpy array (uint8) with a value per tile
+    def heatmapIndices(job, integral, tile):
+        rMeans, gMeans, bMeans, counts = integral.tileMeans(tile)
+        return numpy.minimum(o3core.PROFILE.scale(rMeans, gMeans, bMeans), 181).astype(numpy.uint8)
+
+    ## Shows a heatmap. Every tile is a pixel of an indexed image whose colors
+    # are those of the Ozone Scale, semi-transparent. Values out of the scale
+    # are shown in gray.
+    # @param indices see heatmapIndices
+    def showHeatmap(self, indices):
+        if SelectableImage.heatmapColors == None :
+            SelectableImage.heatmapColors = [QColor.fromHsv(o3core.PROFILE.hue(scale), 255, 255, 128).rgba()
+                                             for scale in range(181)] + [qRgba(128, 128, 128, 128)]
+        rows, columns = indices.shape
+        self.heatmap = QImage(indices.tobytes(), columns, rows, columns, QImage.Format_Indexed8).copy()
+        self.heatmap.setColorTable(SelectableImage.heatmapColors)
+        self.update()
+
+    ## When the mouse is pressed down over the image, a QRubberBand is created
+    # and the coordinates are saved.
+    def mousePressEvent(self, event):
+        self.origin = event.pos()        
+        if not self.rubberBand:
+            self.rubberBand = QRubberBand(QRubberBand.Rectangle, self)
+        self.rubberBand.setGeometry(QRect(self.origin, QSize()))
+        self.rubberBand.show()
+
+    ## Maps the selection between the origin and the given point from the
+    # coordinates of the label to the coordinates of the image.
+    # @returns tuple (x0, y0, x1, y1) with x1 and y1 exclusive
+    def selection(self, destination):
+        imgSize = self.image.size()
+        lsize = self.size()
+
+        xo = int((min(self.origin.x(), destination.x()) * imgSize.width()) / lsize.width())
+        xd = int((max(self.origin.x(), destination.x()) * imgSize.width()) / lsize.width()) + 1
+        yo = int((min(self.origin.y(), destination.y()) * imgSize.height()) / lsize.height())
+        yd = int((max(self.origin.y(), destination.y()) * imgSize.height()) / lsize.height()) + 1
+        return xo, yo, xd, yd
+
+    ## Measures a rectangle of the image. This is a job function.
+    # @param integral IntegralImage of the image
+    # @param region tuple (x0, y0, x1, y1), see selection
+    # @returns dictionary with the Ozone Scale value ('scale'), the mean color,
+    # the number of pixels, the region and the profile, or None if the
+    # selection is empty
+    def measureRegion(job, integral, region):
+        xo, yo, xd, yd = region
+        means = integral.mean(xo, yo, xd, yd)
+        if means == None :
+            return None
+        rMean, gMean, bMean, nvals = means
+        profile = o3core.PROFILE
+        return {'scale': profile.scale(rMean, gMean, bMean), 'red': rMean, 'green': gMean,
+                'blue': bMean, 'pixels': nvals,
+                'region': (max(0, xo), max(0, yo), min(xd, integral.width), min(yd, integral.height)),
+                'width': integral.width, 'height': integral.height, 'profile': profile}
+
+    ## When the mouse is moved with a button pressed, the rectangle geometry is
+    # updated and the value of the current selection is previewed. Previews
+    # still running are superseded by the newest one.
+    def mouseMoveEvent(self, event):
+        self.rubberBand.setGeometry(QRect(self.origin, event.pos()).normalized())
+        if self.integral != None :
+            self.jobs.submit('preview', None, SelectableImage.measureRegion, self.integral,
+                             self.selection(event.pos()), done=self.previewRegion)
+
+    ## Reports the preview of a selection.
+    def previewRegion(self, result):
+        if result != None :
+            self.huePreview.emit(result['scale'])
+
+    ## When the mouse button is released, the value of the selection is
+    # computed from the integral image and reported.
+    def mouseReleaseEvent(self, event):
+        self.jobs.cancel('preview')
+        if self.integral != None :
+            self.jobs.submit('region', None, SelectableImage.measureRegion, self.integral,
+                             self.selection(event.pos()), done=self.reportRegion)
+
+    ## Reports the measurement of a selection.
+    def reportRegion(self, result):
+        if result != None :
+            print("Hue of the region: " + str(result['scale']))
+            self.measured.emit(result)
+            self.hueCalculated.emit(result['scale'])
+
+    ## Loads a picture given a file name. It is looked up in the cache, and
+    # decoded (see readRaw for RAW files) and analysed with the current
+    # profile if it is not cached, in the background (see openImage); it is
+    # shown when done, and a picture still loading is cancelled. Errors are
+    # reported by the job scheduler.
+    # @param fileName name of the file
+    # @param cachePath database file of the ResultCache (None if disabled)
+    # @returns Job
+    def loadImage(self, fileName, cachePath=None):
+        return self.jobs.submit('image', "Opening " + os.path.basename(fileName) + "...",
+                                openImage, cachePath, fileName, self.dropAlpha, o3core.PROFILE,
+                                done=self.setOpenedImage)
+
+    ## Shows a picture opened by openImage: its cached preview (see
+    # setMeasuredImage) or the picture itself (see setAnalysedImage).
+    def setOpenedImage(self, picture):
+        if 'cached' in picture :
+            self.setMeasuredImage(picture['preview'], picture['cached'], picture['file'],
+                                  digest=picture['digest'], profile=picture['profile'])
+        else:
+            self.setAnalysedImage(picture, picture['digest'])
+
+    ## Shows a picture analysed by analyseImage and reports its measurement.
+    # @param picture see analyseImage
+    # @param digest digest of the file, if known
+    def setAnalysedImage(self, picture, digest=None):
+        self.preview = False
+        self.setPicture(picture['file'], picture['buffer'], picture['integral'], picture['pyramid'])
+        self.histogram = picture['histogram']
+        self.digest = digest
+        self.profile = picture['profile']
+        result = picture['result']
+        print("Hue of the stripe: " + str(result['scale']))
+        self.imageMeasured.emit(result)
+        self.measured.emit(result)
+        self.hueCalculated.emit(result['scale'])
+
+    ## Shows the reduced preview of a picture whose measurement is already
+    # known (e.g. from the cache), and loads the picture in the background to
+    # replace it (see setFullImage). Nothing is measured: selections, the
+    # heatmap and the strips wait for the picture, the preview is only shown.
+    # @param newImage QImage with the preview
+    # @param result dictionary with the measurement of the picture
+    # @param fileName name of the file
+    # @param histogram ChannelHistogram of the whole picture, if known
+    # @param digest digest of the file, if known
+    # @param profile Profile of the measurement (default: the current one)
+    def setMeasuredImage(self, newImage, result, fileName, histogram=None, digest=None, profile=None):
+        self.jobs.cancel('image')
+        self.preview = True
+        buffer = ImageBuffer(newImage, self.dropAlpha)
+        self.setPicture(fileName, buffer, None, ImagePyramid(buffer.image, buffer.array()))
+        self.histogram = histogram
+        self.digest = digest
+        self.profile = profile or o3core.PROFILE
+        print("Hue of the stripe: " + str(result['scale']))
+        self.measured.emit(result)
+        self.hueCalculated.emit(result['scale'])
+        self.jobs.submit('full', "Loading " + os.path.basename(fileName) + "...",
+                         analyseImage, fileName, self.dropAlpha, self.profile, done=self.setFullImage)
+
+    ## Replaces the preview shown by setMeasuredImage with the picture,
+    # keeping the view. Its measurement was already reported.
+    # @param picture see analyseImage
+    def setFullImage(self, picture):
+        self.scaleFactor = self.width() / picture['buffer'].image.width()
+        self.image = picture['buffer'].image
+        self.arr = picture['buffer'].array()
+        self.integral = picture['integral']
+        self.pyramid = picture['pyramid']
+        if self.histogram == None :
+            self.histogram = picture['histogram']
+        self.preview = False
+        self.updateHeatmap()
+        self.imageLoaded.emit(self.fileName)
+
+    ## Shows a picture in the widget together with the data needed to process
+    # selections. The jobs about the previous picture are cancelled.
+    # @param fileName name of the file
+    # @param buffer ImageBuffer with the picture
+    # @param integral IntegralImage of the picture
+    # @param pyramid ImagePyramid of the picture
+    def setPicture(self, fileName, buffer, integral, pyramid):
+        for kind in ('full', 'preview', 'region', 'heatmap', 'strips'):
+            self.jobs.cancel(kind)
+        self.fileName = fileName
+        self.image = buffer.image
+        self.arr = buffer.array()
+        self.integral = integral
+        self.pyramid = pyramid
+        self.histogram = None
+        self.digest = self.profile = None
+        
+        self.scaleFactor = 1.0
+        self.resize(self.image.size())
+        self.strips = []
+        self.updateHeatmap()
+
+        if (self.rubberBand):
+            self.rubberBand.hide()
+        self.imageChanged.emit(fileName)
+
+################################################################################
+#
+# Main window class
+#
+class MainWindow(QMainWindow):
+    # File shown, and file opened last, which may still be loading
+    currentFile = None
+    openingFile = None
+    
+    def __init__(self):
+        super().__init__()
+        self.jobs = JobScheduler(self)
+        try:
+            setProfile(Profile.load(Profile.defaultName()))
+        except ValueError as e:
+            print("Using the default profile: " + str(e), file=sys.stderr)
+        try:
+            self.cache = ResultCache()
+        except (OSError, sqlite3.Error) as e:
+            print("Cache disabled: " + str(e), file=sys.stderr)
+            self.cache = None
+        try:
+            self.store = MeasurementStore()
+        except (OSError, sqlite3.Error) as e:
+            print("Measurements will not be saved: " + str(e), file=sys.stderr)
+            self.store = None
+        self.series = SeriesAggregator()
+        self.initUI()
+        self.updateSeries()
+
+    ## Stops the running jobs and writes the pending measurements before
+    # closing.
+    def closeEvent(self, event):
+        self.jobs.shutdown()
+        if self.store != None :
+            self.store.close()
+            self.store = None
+        super().closeEvent(event)
+
+    ## Shows a dialog to open a new file
+    def openf(self):
+        dialog = QFileDialog(self, "Open File")
+        dialog.setNameFilters(["Pictures (" + " ".join("*" + ext for ext in IMAGE_EXTENSIONS) + ")",
+                               "All files (*)"])
+        if not dialog.exec() :
+            return
+        if (len(dialog.selectedFiles()) > 0):
+            self.openFile(dialog.selectedFiles()[0])
+
+    ## Opens a file. Cached pictures are shown at once, the others when they
+    # have been loaded in the background (see showOpened).
+    def openFile(self, fileName):
+        self.openingFile = fileName
+        self.simage.loadImage(fileName, self.cache.path if self.cache != None else None)
+
+    ## Qt Slot: updates the window for the picture just shown.
+    def showOpened(self, fileName):
+        self.currentFile = fileName
+
+        self.setWindowFilePath(fileName)
+        self.setWindowTitle('O3METER - ' + fileName)
+
+        self.updateColor(0)
+        self.lcd.display(0)
+
+        self.scrollArea.setVisible(True)
+        self.gridc.setVisible(True)
+        
+        self.zoominAction.setEnabled(True)
+        self.zoomoutAction.setEnabled(True)
+        self.fittowindowAction.setEnabled(True)
+        self.heatmapAction.setEnabled(True)
+        self.heatmapTileAction.setEnabled(True)
+        self.stripsAction.setEnabled(True)
+
+        self.scale.updatePointer(0)
+
+        self.fittowindow()
+
+        self.statusBar().showMessage("Opened: " + fileName + (" (cached preview)" if self.simage.preview else ""))
+
+    ## Qt Slot: updates the window for the picture that replaced its cached
+    # preview.
+    def showLoaded(self, fileName):
+        self.statusBar().showMessage("Loaded: " + fileName)
+
+    ## Qt Slot: shows the running job, if any, in the status bar.
+    def showJobs(self):
+        jobs = [job for job in self.jobs.running() if job.label != None]
+        if not jobs :
+            self.jobLabel.hide()
+            self.jobProgress.hide()
+            self.cancelButton.hide()
+            return
+        self.showProgress(jobs[-1], 0, 0)
+        self.jobLabel.show()
+        self.jobProgress.show()
+        self.cancelButton.show()
+
+    ## Qt Slot: shows the progress of a job in the status bar.
+    def showProgress(self, job, value, maximum):
+        jobs = [job for job in self.jobs.running() if job.label != None]
+        if not jobs or job is not jobs[-1] :
+            return
+        self.jobLabel.setText(job.label)
+        self.jobProgress.setMaximum(maximum)
+        self.jobProgress.setValue(value)
+
+    ## Qt Slot: cancels all the running jobs.
+    def cancelJobs(self):
+        self.jobs.cancel()
+        self.statusBar().showMessage("Cancelled")
+
+    ## Qt Slot: reports a failed job.
+    def jobFailed(self, kind, message):
+        if kind == 'image' :
+            self.statusBar().showMessage("Cannot open file")
+            QMessageBox.information(self, QGuiApplication.applicationDisplayName(),
+                                    "Cannot open file: " + message)
+        else:
+            self.statusBar().showMessage("Error: " + message)
+
+    ## Qt Slot: stores the measurement of the whole image in the cache, under
+    # the digest of the picture shown and the profile it was measured with.
+    # The preview is made and written in the background (see cacheImage).
+    def cacheResult(self, result):
+        if self.cache == None or self.simage.digest == None :
+            return
+        self.jobs.submit('cache', None, cacheImage, self.cache.path, self.simage.digest, self.simage.profile,
+                         result, self.simage.arr, self.simage.histogram, self.simage.fileName)
+
+    ## Qt Slot: makes the profile of a menu action the current one and
+    # measures the picture again with it, without decoding it if its
+    # histogram is known.
+    def selectProfile(self, action):
+        try:
+            profile = Profile.load(action.data())
+        except ValueError as e:
+            QMessageBox.warning(self, "Profile", str(e))
+            return
+        setProfile(profile)
+        self.updateColor(self.lcd.intValue())
+        self.chart.update()
+        self.statusBar().showMessage("Profile: " + profile.name)
+        if any(job.kind == 'image' for job in self.jobs.running()) :
+            # The picture loading is measured with the previous profile
+            self.openFile(self.openingFile)
+            return
+        if self.currentFile == None :
+            return
+
+        if self.simage.histogram == None and self.simage.digest != None :
+            try:
+                self.simage.histogram = self.cache.histogram(self.simage.digest)
+            except sqlite3.Error as e:
+                print("Cache lookup failed: " + str(e), file=sys.stderr)
+        try:
+            if not self.simage.rescore():
+                self.openFile(self.currentFile)
+        except ValueError as e:
+            self.statusBar().showMessage("Error: " + str(e))
+
+    ## Qt Slot: lists the profiles in the profile menu.
+    def updateProfileMenu(self):
+        self.profileMenu.clear()
+        for name in Profile.names():
+            action = self.profileMenu.addAction(name)
+            action.setData(name)
+            action.setCheckable(True)
+            action.setChecked(name == o3core.PROFILE.name)
+            self.profileGroup.addAction(action)
+
+    ## Qt Slot: saves a measurement in the store. Writes are grouped: the
+    # store is flushed a second after the first pending measurement.
+    def logValue(self, result):
+        if self.store == None :
+            return
+        if not self.store.pending :
+            QTimer.singleShot(1000, self.flushStore)
+        self.store.add(self.currentFile, result)
+
+    ## Writes the pending measurements.
+    def flushStore(self):
+        if self.store == None :
+            return
+        try:
+            self.store.flush()
+        except sqlite3.Error as e:
+            self.statusBar().showMessage("Cannot save measurements: " + str(e))
+            return
+        self.updateSeries()
+
+    ## Reads the measurements stored since the last update in the background,
+    # to add them to the chart (see showSeries).
+    def updateSeries(self):
+        if self.store == None :
+            return
+        self.jobs.submit('series', None, readSeries, self.store.path, self.series.lastId, done=self.showSeries)
+
+    ## Adds new measurements to the aggregates and redraws the chart.
+    # @param rows see MeasurementStore.series
+    def showSeries(self, rows):
+        if self.store == None :
+            return
+        self.series.add(rows)
+        self.chart.setSeries(self.series.recent(self.store.station, SeriesWidget.DAYS))
+
+    ## Qt Slot: zooms in the image.
+    def zoomin(self):
+        self.scaleImage(1.25)
+
+    ## Qt Slot: zooms out the image.
+    def zoomout(self):
+        self.scaleImage(0.8)
+
+    ## Qt Slot: fits the image to the window.
+    def fittowindow(self):
+        wsize = self.scrollArea.viewport().size()
+        if wsize.width() == 0 :
+            wsize.setWidth(self.splitter.width() - self.gridc.maximumWidth())            
+        
+        isize = self.simage.image.size()
+        
+        wfactor = wsize.width() / isize.width()
+        hfactor = wsize.height() / isize.height()
+
+        self.simage.scaleFactor = 1.0
+        self.scaleImage(min(wfactor, hfactor))
+
+    ## Adjusts a scroll bar by a given factor.
+    def adjustScrollBar(self, scrollBar, factor):
+        scrollBar.setValue(int(factor * scrollBar.value() + ((factor - 1) * scrollBar.pageStep()/2)))
+
+    ## Qt Slot: scales the image by a given factor.
+    def scaleImage(self, factor):
+        scaleFactor = self.simage.scale(factor)
+        self.adjustScrollBar(self.scrollArea.horizontalScrollBar(), factor)
+        self.adjustScrollBar(self.scrollArea.verticalScrollBar(), factor)
+        self.statusBar().showMessage("Scaled to : " + str(int(scaleFactor * 100))+"%")
+
+    ## Qt Slot: changes the hue of the color widget.
+    def updateColor(self, hue):
+        self.palette.setColor(QPalette.Background, QColor.fromHsv(o3core.PROFILE.hue(hue), 255, 255))
+        self.colorw.setPalette(self.palette)
+
+    ## Qt Slot: shows or hides the heatmap.
+    def showHeatmap(self, checked):
+        self.simage.setHeatmap(checked)
+
+    ## Qt Slot: asks for the size of the heatmap tiles. Smaller tiles than a
+    # step of the integral image would need arrays as large as the picture
+    # (see IntegralImage.tileMeans).
+    def heatmapTile(self):
+        tile, ok = QInputDialog.getInt(self, "Heatmap", "Tile size (pixels):", self.simage.heatmapTile,
+                                       IntegralImage.ROW_STEP, 4096, IntegralImage.ROW_STEP)
+        if ok :
+            self.simage.setHeatmap(self.heatmapAction.isChecked(), tile)
+
+    ## Qt Slot: shows or hides the statistics panel.
+    def showStats(self, checked):
+        self.statsDock.setVisible(checked)
+        if checked :
+            self.updateStats()
+            self.statsTimer.start()
+        else:
+            self.statsTimer.stop()
+
+    ## Qt Slot: refreshes the statistics panel.
+    def updateStats(self):
+        self.statsView.setPlainText(STATS.report())
+
+    ## Qt Slot: detects and measures the strips of the image.
+    def detectStrips(self):
+        self.simage.detectStrips()
+
+    ## Qt Slot: shows the values of the detected strips.
+    def showStrips(self, strips):
+        if not strips :
+            self.statusBar().showMessage("No strips found")
+            return
+        self.statusBar().showMessage("Strips: " + ", ".join(str(strip['scale']) for strip in strips))
+        QMessageBox.information(self, "Strips",
+                                "<br/>".join("Strip " + str(i + 1) + ": " + str(strip['scale'])
+                                             for i, strip in enumerate(strips)))
+
+    ## Qt Slot: shows the about dialog.
+    def about(self):
+        QMessageBox.about(self, "About O3METER",
+            "Copyright (C) 2018 - Universidade de Vigo <br/> \
+             Orlando Garcia-Feal - <a href=mailto:orlando@uvigo.es>orlando@uvigo.es</a>  <br/><br/> \
+            This program is free software; you can redistribute it and/or \
+            modify it under the terms of the GNU General Public License \
+            as published by the Free Software Foundation; either version 3 \
+            of the License, or (at your option) any later version. \
+            <br/><br/> \
+            This program is distributed in the hope that it will be useful, \
+            but WITHOUT ANY WARRANTY; without even the implied warranty of \
+            MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the \
+            GNU General Public License for more details. \
+            <br/><br/> \
+            You should have received a copy of the GNU General Public License \
+            along with this program.  If not, see <https://www.gnu.org/licenses/>.")
+
+    ## Initializes the user interface
+    def initUI(self):               
+
+        # Define actions        
+        self.openAction = QAction(QIcon.fromTheme('document-open'), '&Open', self)
+        self.openAction.setShortcut('Ctrl+O')
+        self.openAction.setStatusTip('Open RAW file')
+        self.openAction.triggered.connect(self.openf)
+        
+        self.exitAction = QAction(QIcon.fromTheme('application-exit'), '&Exit', self)        
+        self.exitAction.setShortcut('Ctrl+Q')
+        self.exitAction.setStatusTip('Exit application')
+        self.exitAction.triggered.connect(qApp.quit)
+
+        self.zoominAction = QAction(QIcon.fromTheme('zoom-in'), 'Zoom in', self)
+        self.zoominAction.setShortcut('Ctrl++')
+        self.zoominAction.setStatusTip("Zoom In")
+        self.zoominAction.setEnabled(False)
+        self.zoominAction.triggered.connect(self.zoomin)
+
+        self.zoomoutAction = QAction(QIcon.fromTheme('zoom-out'), 'Zoom out', self)
+        self.zoomoutAction.setShortcut('Ctrl++')
+        self.zoomoutAction.setStatusTip("Zoom Out")
+        self.zoomoutAction.setEnabled(False)
+        self.zoomoutAction.triggered.connect(self.zoomout)
+
+        self.fittowindowAction = QAction(QIcon.fromTheme('zoom-fit-best'), 'Fit to window', self)
+        self.fittowindowAction.setShortcut('Ctrl+F')
+        self.fittowindowAction.setStatusTip("Fit to window")
+        self.fittowindowAction.setEnabled(False)
+        self.fittowindowAction.triggered.connect(self.fittowindow)
+        
+        self.heatmapAction = QAction(QIcon.fromTheme('view-grid'), 'Heatmap', self)
+        self.heatmapAction.setShortcut('Ctrl+H')
+        self.heatmapAction.setStatusTip("Show the Ozone Scale value of every tile of the image")
+        self.heatmapAction.setCheckable(True)
+        self.heatmapAction.setEnabled(False)
+        self.heatmapAction.toggled.connect(self.showHeatmap)
+
+        self.heatmapTileAction = QAction('Heatmap tile size...', self)
+        self.heatmapTileAction.setStatusTip("Change the size of the heatmap tiles")
+        self.heatmapTileAction.setEnabled(False)
+        self.heatmapTileAction.triggered.connect(self.heatmapTile)
+
+        self.stripsAction = QAction(QIcon.fromTheme('edit-find'), 'Detect strips', self)
+        self.stripsAction.setShortcut('Ctrl+D')
+        self.stripsAction.setStatusTip("Find and measure every strip of the image")
+        self.stripsAction.setEnabled(False)
+        self.stripsAction.triggered.connect(self.detectStrips)
+
+        self.statsAction = QAction('Statistics', self)
+        self.statsAction.setShortcut('Ctrl+I')
+        self.statsAction.setStatusTip("Show where the processing time goes")
+        self.statsAction.setCheckable(True)
+        self.statsAction.toggled.connect(self.showStats)
+
+        self.aboutAct = QAction("&About", self)
+        self.aboutAct.setStatusTip("Show the application's About box")
+        self.aboutAct.triggered.connect(self.about)
+
+        self.aboutQtAct = QAction("About &Qt", self)
+        self.aboutQtAct.setStatusTip("Show the Qt library's About box")
+        self.aboutQtAct.triggered.connect(QApplication.aboutQt)
+
+        # Status bar        
+        self.statusBar()
+
+        # Menu Bar        
+        menubar = self.menuBar()
+        fileMenu = menubar.addMenu('&File')
+        viewMenu = menubar.addMenu('&View')
+        measureMenu = menubar.addMenu('&Measure')
+        aboutMenu = menubar.addMenu('&About')
+        
+        fileMenu.addAction(self.openAction)
+        fileMenu.addAction(self.exitAction)
+
+        viewMenu.addAction(self.heatmapAction)
+        viewMenu.addAction(self.heatmapTileAction)
+        viewMenu.addSeparator()
+        viewMenu.addAction(self.statsAction)
+
+        measureMenu.addAction(self.stripsAction)
+        measureMenu.addSeparator()
+        self.profileMenu = measureMenu.addMenu('&Profile')
+        self.profileGroup = QActionGroup(self)
+        self.profileGroup.triggered.connect(self.selectProfile)
+        self.profileMenu.aboutToShow.connect(self.updateProfileMenu)
+        self.updateProfileMenu()
+
+        aboutMenu.addAction(self.aboutAct)
+        aboutMenu.addAction(self.aboutQtAct)
+
+        # Tool Bar
+        toolbar = self.addToolBar('Tools')                
+
+        toolbar.addAction(self.openAction)
+        toolbar.addAction(self.fittowindowAction)
+        toolbar.addAction(self.zoominAction)
+        toolbar.addAction(self.zoomoutAction)
+        toolbar.addAction(self.heatmapAction)
+        toolbar.addAction(self.stripsAction)        
+
+        # Image Label    
+        self.simage = SelectableImage(self, self.jobs)
+        self.simage.setBackgroundRole(QPalette.Base)
+        self.simage.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+        self.simage.setScaledContents(True)
+
+        # Scroll Area
+        self.scrollArea = QScrollArea(self)
+        self.scrollArea.setBackgroundRole(QPalette.Dark)
+        self.scrollArea.setWidget(self.simage)
+        self.scrollArea.setVisible(False)
+
+        # LCD Label
+        self.lcdlabel = QLabel("Scale from 0 to 180")
+        self.lcdlabel.setAlignment(Qt.AlignHCenter | Qt.AlignBottom)
+        
+        # LCD Number
+        self.lcd = QLCDNumber(self)
+        self.lcd.display(0)
+
+        # Color Widget & Palette
+        self.colorw = QLabel(self)
+        self.colorw.setFrameStyle(QFrame.Box | QFrame.Raised)
+        self.palette = QPalette()
+        self.palette.setColor(QPalette.Background, QColor(255, 255, 255))
+        self.colorw.setPalette(self.palette)
+        self.colorw.setAutoFillBackground(True)
+
+        # Color scale
+        self.scale = ScaleWidget(self)
+
+        # Recent measurements of the station
+        self.chart = SeriesWidget(self)
+        
+        # Grid Container
+        self.gridc = QWidget(self)
+        self.gridc.setMaximumWidth(300)        
+        self.gridc.setVisible(False)
+        
+        # Grid Layout
+        self.grid = QGridLayout(self.gridc)
+        self.grid.addWidget(self.lcdlabel, 0, 0)
+        self.grid.addWidget(self.lcd, 1, 0)
+        self.grid.addWidget(self.colorw, 2, 0)
+        self.grid.addWidget(self.scale, 3, 0)
+        self.grid.addWidget(self.chart, 4, 0)
+        
+        # Splitter
+        self.splitter = QSplitter(self)
+        self.splitter.setOrientation(Qt.Horizontal)
+        self.splitter.addWidget(self.gridc)
+        self.splitter.addWidget(self.scrollArea)
+
+        self.setCentralWidget(self.splitter)
+
+        # Statistics panel, refreshed every second while it is shown
+        self.statsView = QPlainTextEdit(self)
+        self.statsView.setReadOnly(True)
+        self.statsView.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.statsDock = QDockWidget("Statistics", self)
+        self.statsDock.setWidget(self.statsView)
+        self.statsDock.visibilityChanged.connect(self.statsAction.setChecked)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.statsDock)
+        self.statsDock.hide()
+        self.statsTimer = QTimer(self)
+        self.statsTimer.setInterval(1000)
+        self.statsTimer.timeout.connect(self.updateStats)
+
+        # Progress of the background jobs
+        self.jobLabel = QLabel(self)
+        self.jobProgress = QProgressBar(self)
+        self.jobProgress.setMaximumWidth(200)
+        self.cancelButton = QPushButton("Cancel", self)
+        self.cancelButton.clicked.connect(self.cancelJobs)
+        for widget in (self.jobLabel, self.jobProgress, self.cancelButton):
+            self.statusBar().addPermanentWidget(widget)
+            widget.hide()
+
+        # Connect signals & slots
+        self.simage.hueCalculated.connect(self.lcd.display)
+        self.simage.hueCalculated.connect(self.updateColor)
+        self.simage.hueCalculated.connect(self.scale.updatePointer)
+        self.simage.measured.connect(self.logValue)
+        self.simage.imageMeasured.connect(self.cacheResult)
+        self.simage.huePreview.connect(self.lcd.display)
+        self.simage.huePreview.connect(self.updateColor)
+        self.simage.huePreview.connect(self.scale.updatePointer)
+        self.simage.imageChanged.connect(self.showOpened)
+        self.simage.imageLoaded.connect(self.showLoaded)
+        self.simage.stripsDetected.connect(self.showStrips)
+        self.jobs.started.connect(self.showJobs)
+        self.jobs.finished.connect(self.showJobs)
+        self.jobs.progressed.connect(self.showProgress)
+        self.jobs.failed.connect(self.jobFailed)
+        
+        self.setGeometry(300, 300, 300, 200)
+        self.setWindowTitle('O3METER')    
+        self.show()
+        
@@ -0,0 +1,62 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# O3METER
+# Copyright (C) 2018 Orlando Garcia-Feal - Universidade de Vigo - orlando@uvigo.es
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+################################################################################
+#
+# Tests of the report subcommand on stores without matching measurements.
+#
+#   python3 -m unittest discover tests
+#
+import sys, os, subprocess, tempfile, unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+PROGRAM = os.path.join(ROOT, 'O3METER.py')
+sys.path.insert(0, ROOT)
+from o3core import MeasurementStore
+
+class EmptyReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.directory.name, "measurements.sqlite")
+        MeasurementStore(self.store).close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    ## Runs the report subcommand on the store.
+    # @returns standard output
+    def report(self, *args):
+        process = subprocess.run([sys.executable, PROGRAM, 'report', '--store', self.store] + list(args),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        return process.stdout
+
+    def test_trends(self):
+        self.assertEqual(self.report('--trends').splitlines(),
+                         ["station,first,last,days,count,mean,trend,outliers"])
+
+    def test_trends_unknown_station(self):
+        store = MeasurementStore(self.store, 'here')
+        store.add("a.png", {'scale': 100, 'red': 1, 'green': 2, 'blue': 3, 'pixels': 4})
+        store.close()
+        self.assertEqual(len(self.report('--trends', '--station', 'elsewhere').splitlines()), 1)
+
+if __name__ == '__main__':
+    unittest.main()